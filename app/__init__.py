@@ -15,6 +15,22 @@ app = Flask(__name__)
 CORS(app)
 app.config["JWT_SECRET_KEY"] = os.getenv("JWT_SECRET_KEY")
 app.config["JWT_ACCESS_TOKEN_EXPIRES"] = timedelta(days=30)
+app.config["JWT_REVOCATION_CACHE_TTL"] = float(os.getenv("JWT_REVOCATION_CACHE_TTL", "5"))
+app.config["JWT_REVOCATION_CACHE_SIZE"] = int(os.getenv("JWT_REVOCATION_CACHE_SIZE", "100000"))
+app.config["RESTAURANT_CACHE_TTL"] = float(os.getenv("RESTAURANT_CACHE_TTL", "30"))
+app.config["RESTAURANT_CACHE_REDIS_TTL"] = float(os.getenv("RESTAURANT_CACHE_REDIS_TTL", "600"))
+app.config["RESTAURANT_CACHE_SIZE"] = int(os.getenv("RESTAURANT_CACHE_SIZE", "10000"))
+app.config["LIKE_FLUSH_INTERVAL"] = float(os.getenv("LIKE_FLUSH_INTERVAL", "10"))
+app.config["SEARCH_CACHE_TTL"] = float(os.getenv("SEARCH_CACHE_TTL", "60"))
+app.config["SEARCH_CACHE_SIZE"] = int(os.getenv("SEARCH_CACHE_SIZE", "10000"))
+app.config["RECOMMEND_STORAGE"] = os.getenv("RECOMMEND_STORAGE", "ids") # "ids" or "full"
+app.config["RECOMPUTE_WORKERS"] = int(os.getenv("RECOMPUTE_WORKERS", "2"))
+app.config["RECOMPUTE_MAX_PENDING"] = int(os.getenv("RECOMPUTE_MAX_PENDING", "1000"))
+app.config["RECOMPUTE_INTERVAL"] = float(os.getenv("RECOMPUTE_INTERVAL", "300"))
+app.config["RECOMPUTE_BATCH_SIZE"] = int(os.getenv("RECOMPUTE_BATCH_SIZE", "100"))
+app.config["RANDOM_POOL_COUNT"] = int(os.getenv("RANDOM_POOL_COUNT", "8"))
+app.config["RANDOM_POOL_SIZE"] = int(os.getenv("RANDOM_POOL_SIZE", "1000"))
+app.config["RANDOM_POOL_INTERVAL"] = float(os.getenv("RANDOM_POOL_INTERVAL", "300"))
 jwt = JWTManager(app)
 api = Api(app)
 client = MongoClient(os.getenv("MONGO_URI"))
@@ -25,6 +41,7 @@ redis_db = redis.Redis(host=os.getenv("REDIS_HOST"),
                        decode_responses=True)
 
 
+from app import metrics
 from app import index
 from app import recommender
 from app import auth, posts, comments, restaurants, search
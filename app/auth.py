@@ -5,7 +5,8 @@ from flask_restful import Resource, reqparse
 from flask_jwt_extended import create_access_token, get_jwt, jwt_required
 from app import nckufeed_db, api, redis_db
 from app.models import User
-from app.utils import create_user_hmap, RecommendComputeTask
+from app.utils import DatabaseProcessor, build_update, create_user_hmap, recompute_scheduler, \
+    token_revocation_cache
 
 
 user_args = reqparse.RequestParser()
@@ -111,28 +112,26 @@ class Auth(Resource):
         args = user_args.parse_args()
         claims = get_jwt()
         uid = claims["uid"]
-        user_collection = nckufeed_db["users"]
-        if args.name is not None:
-            user_collection.update_one({"uid": uid},
-                                       {"$set": {"nick_name": args.name}})
-        if args.profile_photo is not None:
-            user_collection.update_one({"uid": uid},
-                                       {"$set": {"profile_photo": args.profile_photo}})
-        if args.self_intro is not None:
-            user_collection.update_one({"uid": uid}, {"$set": {"self_intro": args.self_intro}})
-        if args.restaurant_id is not None:
-            user_collection.update_one({"uid": uid},
-                                       {"$push": {"restaurants_id": args.restaurant_id}})
+        update = build_update(
+            set_fields={
+                "nick_name": args.name,
+                "profile_photo": args.profile_photo,
+                "self_intro": args.self_intro
+            },
+            push={"restaurants_id": args.restaurant_id}
+        )
+        user = DatabaseProcessor().patch_user(uid, update)
+        if user is None:
+            return {"message": "update user error."}, 500
+        recompute_job = None
         if args.preference is not None:
-            # Only run this when the user is new
-            create_user_hmap(uid, args.preference)
-            thread = RecommendComputeTask(uid)
-            thread.start()
-            # TODO: Fix waiting problem
-            thread.join()
-            create_user_hmap(uid, args.preference)
-        user = User(**user_collection.find_one({"uid": uid}))
-        return user.dict(), 200
+            # Only run this when the user is new. Recommend list is computed
+            # in background, recommender serves a temporary list until done.
+            create_user_hmap(uid, args.preference, overwrite=True)
+            job = recompute_scheduler.submit(uid, args.preference)
+            if job is not None:
+                recompute_job = job.job_id
+        return {**User(**user).dict(), "recompute_job": recompute_job}, 200
 
     @jwt_required()
     def delete(self):
@@ -165,9 +164,10 @@ class Logout(Resource):
 
         jti = get_jwt()["jti"]
         uid = get_jwt()["uid"]
-        thread = RecommendComputeTask(uid)
-        thread.start()
+        # Preferences are saved by the dirty user recomputer, keep them until then
+        redis_db.expire(uid, timedelta(days=1))
         redis_db.set(jti, "", ex=timedelta(hours=1))
+        token_revocation_cache.revoke(jti, timedelta(hours=1))
         return {"message": "Logout successfully."}, 200
 
 
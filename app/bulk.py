@@ -0,0 +1,247 @@
+"""Bulk import and export of the restaurant catalog.
+
+Usage:
+    python -m app.bulk import FILE [--format ndjson|csv] [--chunk-size N]
+    python -m app.bulk export [FILE] [--fields FIELD ...] [--batch-size N]
+
+FILE is NDJSON, one restaurant object per line, or CSV with a header row,
+``-`` reads stdin. In CSV, list fields are separated by ``|`` or written as
+JSON, and ``frontend_tags`` is JSON. A row with ``_id`` replaces that
+restaurant, other rows replace the restaurant with the same name and
+address or insert a new one.
+
+Export writes NDJSON to FILE or stdout one restaurant at a time, so memory
+stays flat however large the catalog is. Its output can be imported again.
+"""
+
+import argparse
+import csv
+import json
+import sys
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo import ReplaceOne
+from pymongo.errors import BulkWriteError, OperationFailure
+from app import nckufeed_db
+from app.catalog import bump_catalog_version
+from app.models import Restaurant
+from app.utils import DatabaseProcessor, restaurant_cache
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_BATCH_SIZE = 1000
+
+# Only the first errors are reported in detail, the rest are counted
+MAX_REPORTED_ERRORS = 1000
+
+LIST_FIELDS = ("photos", "tags", "open_hour", "service")
+
+
+def read_ndjson(stream):
+    """Yield (line number, row, error) of every non empty line."""
+
+    for number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield number, None, "invalid json: %s" % error
+            continue
+        if isinstance(row, dict):
+            yield number, row, None
+        else:
+            yield number, None, "row is not an object"
+
+
+def parse_csv_row(row: dict) -> dict:
+    """Convert a CSV row of strings to restaurant fields."""
+
+    parsed = {}
+    for field, value in row.items():
+        if field is None or value is None or not value.strip():
+            continue
+        value = value.strip()
+        if field in LIST_FIELDS:
+            value = json.loads(value) if value.startswith("[") else \
+                [item.strip() for item in value.split("|") if item.strip()]
+        elif field == "frontend_tags":
+            value = json.loads(value)
+        parsed[field] = value
+    return parsed
+
+
+def read_csv(stream):
+    """Yield (line number, row, error) of every data row."""
+
+    for number, row in enumerate(csv.DictReader(stream), start=2):
+        try:
+            yield number, parse_csv_row(row), None
+        except ValueError as error:
+            yield number, None, "invalid json: %s" % error
+
+
+READERS = {
+    "ndjson": read_ndjson,
+    "csv": read_csv
+}
+
+
+def restaurant_request(row: dict) -> ReplaceOne:
+    """Validate a row and build its upsert.
+
+    Raise:
+        ValueError if the row is not a valid restaurant.
+    """
+
+    restaurant_id = row.pop("_id", None) or row.pop("id", None)
+    if restaurant_id is not None and not ObjectId.is_valid(str(restaurant_id)):
+        raise ValueError("invalid _id %r" % restaurant_id)
+    restaurant = Restaurant(**row).dict(exclude={"restaurant_id"})
+    if restaurant_id is not None:
+        query = {"_id": ObjectId(str(restaurant_id))}
+    else:
+        query = {"name": restaurant["name"], "address": restaurant["address"]}
+    return ReplaceOne(query, restaurant, upsert=True)
+
+
+class ImportReport:
+    """Counts and row errors of one import."""
+
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+
+    def add_error(self, line: int, message: str):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line, "error": message})
+
+    def dict(self) -> dict:
+        return {
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "failed": self.failed,
+            "errors": self.errors
+        }
+
+
+def write_chunk(collection, lines: list, requests: list, report: ImportReport):
+    """Upsert one chunk, rows are written independently of each other."""
+
+    try:
+        result = collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as error:
+        details = error.details
+        report.inserted += details.get("nUpserted", 0)
+        report.updated += details.get("nMatched", 0)
+        for write_error in details.get("writeErrors", []):
+            report.add_error(lines[write_error["index"]], write_error.get("errmsg", "write failed"))
+    except OperationFailure as error:
+        for line in lines:
+            report.add_error(line, str(error))
+    else:
+        report.inserted += result.upserted_count
+        report.updated += result.matched_count
+
+
+def import_restaurants(stream, file_format: str = "ndjson",
+                       chunk_size: int = DEFAULT_CHUNK_SIZE) -> dict:
+    """Stream restaurants into database in chunks.
+
+    Rows are validated against ``Restaurant`` and upserted with unordered
+    ``bulk_write``, invalid rows are reported and skipped. Restaurant cache
+    and catalog mirrors are invalidated once after the import.
+
+    Args:
+        stream: text stream of NDJSON or CSV
+        file_format (str): "ndjson" or "csv"
+        chunk_size (int): number of rows per ``bulk_write``
+
+    Return:
+        Dict of number of rows, inserted, updated and failed restaurants,
+        and errors with line numbers.
+    """
+
+    collection = nckufeed_db["restaurants"]
+    report = ImportReport()
+    lines, requests = [], []
+    try:
+        for line, row, error in READERS[file_format](stream):
+            report.rows += 1
+            if error is None:
+                try:
+                    requests.append(restaurant_request(row))
+                    lines.append(line)
+                except (ValidationError, ValueError, TypeError) as validation_error:
+                    error = str(validation_error)
+            if error is not None:
+                report.add_error(line, error)
+            if len(requests) >= chunk_size:
+                write_chunk(collection, lines, requests, report)
+                lines, requests = [], []
+        if requests:
+            write_chunk(collection, lines, requests, report)
+    finally:
+        if report.inserted or report.updated:
+            restaurant_cache.clear()
+            bump_catalog_version()
+    return report.dict()
+
+
+def export_restaurants(fields: list = None, batch_size: int = DEFAULT_BATCH_SIZE):
+    """Stream all restaurants as NDJSON.
+
+    Args:
+        fields (list): only export these fields and ``_id`` if given
+        batch_size (int): number of documents per round trip to database
+
+    Return:
+        Generator of NDJSON lines, one restaurant per line.
+    """
+
+    for restaurant in DatabaseProcessor().iter_restaurants(fields, batch_size):
+        yield json.dumps(restaurant, ensure_ascii=False, default=str) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import and export restaurants.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    import_parser = subparsers.add_parser("import", help="import NDJSON or CSV")
+    import_parser.add_argument("file", help="file to import, - for stdin")
+    import_parser.add_argument("--format", choices=sorted(READERS),
+                               help="file format, by file extension if not given")
+    import_parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    export_parser = subparsers.add_parser("export", help="export NDJSON")
+    export_parser.add_argument("file", nargs="?", default="-",
+                               help="file to write, stdout if not given")
+    export_parser.add_argument("--fields", nargs="+", help="only export these fields")
+    export_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.command == "export":
+        if args.file == "-":
+            sys.stdout.writelines(export_restaurants(args.fields, args.batch_size))
+        else:
+            with open(args.file, "w", encoding="utf-8") as stream:
+                stream.writelines(export_restaurants(args.fields, args.batch_size))
+        return
+
+    file_format = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+    if args.file == "-":
+        report = import_restaurants(sys.stdin, file_format, args.chunk_size)
+    else:
+        with open(args.file, encoding="utf-8", newline="") as stream:
+            report = import_restaurants(stream, file_format, args.chunk_size)
+    for error in report["errors"]:
+        print("line %d: %s" % (error["line"], error["error"]), file=sys.stderr)
+    print("Read %d rows, inserted %d, updated %d, failed %d"
+          % (report["rows"], report["inserted"], report["updated"], report["failed"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Provide a two tier read-through cache, in process LRU in front of redis."""
+
+from collections import OrderedDict
+from threading import Lock
+import json
+import time
+from app import redis_db
+from app.metrics import register_metrics
+
+
+# Set a value unless the cache epoch or the key's version changed since they
+# were read. KEYS are the value, epoch and version keys, ARGV are the read
+# epoch and version, the value and its expiry.
+FILL_SCRIPT = """
+local epoch = redis.call("GET", KEYS[2]) or ""
+local version = redis.call("GET", KEYS[3]) or ""
+if epoch == ARGV[1] and version == ARGV[2] then
+    redis.call("SET", KEYS[1], ARGV[3], "EX", ARGV[4])
+end
+return 1
+"""
+
+
+class TwoTierCache:
+    """Read-through cache of JSON serializable values.
+
+    Values are looked up in an in-process LRU first, then in redis which is
+    shared by every worker, and finally loaded by the given loader. The
+    in-process tier keeps values for ``local_ttl`` seconds, so invalidation
+    from another worker is seen at most that late. A value loaded while its
+    key is invalidated is not cached, so it can't outlive the invalidation.
+    Without ``redis_ttl`` only the in-process tier is used.
+    """
+
+    def __init__(self, name: str, local_ttl: float, redis_ttl: float = None, max_size: int = 10000):
+        """Init cache and register its counters.
+
+        Args:
+            name (str): prefix of redis keys and name in metrics
+            local_ttl (float): seconds a value stays in process
+            redis_ttl (float): seconds a value stays in redis, None to
+                skip redis
+            max_size (int): max number of values in process
+
+        """
+        self.__name = name
+        self.__local_ttl = local_ttl
+        self.__redis_ttl = redis_ttl
+        self.__max_size = max_size
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+        # Increased by every invalidation in process, a value loaded before
+        # it is not cached in process
+        self.__generation = 0
+        self.__counters = {"local_hits": 0, "redis_hits": 0, "misses": 0, "invalidations": 0}
+        register_metrics(name, self.stats)
+
+    def __redis_key(self, key: str) -> str:
+        return "cache:%s:%s" % (self.__name, key)
+
+    def __version_key(self, key: str) -> str:
+        return "cache_version:%s:%s" % (self.__name, key)
+
+    def __epoch_key(self) -> str:
+        return "cache_epoch:%s" % self.__name
+
+    def __put_local(self, key: str, value):
+        self.__entries[key] = (value, time.monotonic() + self.__local_ttl)
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+
+    def get(self, key: str, loader):
+        """Get a value, load and cache it on miss.
+
+        Args:
+            key (str): key of the value
+            loader (callable): function taking ``key`` and returning the
+                value, None results are not cached
+
+        Return:
+            The cached or loaded value.
+        """
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self.__entries.move_to_end(key)
+                self.__counters["local_hits"] += 1
+                return entry[0]
+            generation = self.__generation
+
+        serialized = None
+        if self.__redis_ttl is not None:
+            # Versions are read with the value, a value loaded after them is
+            # only cached in redis if no invalidation happened meanwhile
+            pipeline = redis_db.pipeline(transaction=False)
+            pipeline.get(self.__redis_key(key))
+            pipeline.get(self.__epoch_key())
+            pipeline.get(self.__version_key(key))
+            serialized, epoch, version = pipeline.execute()
+        if serialized is not None:
+            value = json.loads(serialized)
+            with self.__lock:
+                self.__counters["redis_hits"] += 1
+                if generation == self.__generation:
+                    self.__put_local(key, value)
+            return value
+
+        value = loader(key)
+        with self.__lock:
+            self.__counters["misses"] += 1
+        if value is not None:
+            if self.__redis_ttl is not None:
+                redis_db.eval(FILL_SCRIPT, 3, self.__redis_key(key), self.__epoch_key(),
+                              self.__version_key(key), epoch or "", version or "",
+                              json.dumps(value, default=str), int(self.__redis_ttl))
+            with self.__lock:
+                if generation == self.__generation:
+                    self.__put_local(key, value)
+        return value
+
+    def invalidate(self, key: str):
+        """Remove a value from both tiers.
+
+        Args:
+            key (str): key of the value
+        """
+
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__generation += 1
+            self.__counters["invalidations"] += 1
+        if self.__redis_ttl is not None:
+            pipeline = redis_db.pipeline()
+            pipeline.delete(self.__redis_key(key))
+            pipeline.incr(self.__version_key(key))
+            pipeline.expire(self.__version_key(key), int(self.__redis_ttl))
+            pipeline.execute()
+
+    def clear(self):
+        """Remove every value from both tiers."""
+
+        self.clear_local()
+        with self.__lock:
+            self.__counters["invalidations"] += 1
+        if self.__redis_ttl is not None:
+            # Values being loaded now are not cached
+            redis_db.incr(self.__epoch_key())
+            keys = []
+            for key in redis_db.scan_iter(match=self.__redis_key("*"), count=1000):
+                keys.append(key)
+                if len(keys) >= 1000:
+                    redis_db.delete(*keys)
+                    keys = []
+            if keys:
+                redis_db.delete(*keys)
+
+    def clear_local(self):
+        """Drop every value cached in process."""
+
+        with self.__lock:
+            self.__entries.clear()
+            self.__generation += 1
+
+    def stats(self) -> dict:
+        """Get cache size and hit/miss counters."""
+
+        with self.__lock:
+            lookups = sum(self.__counters[name] for name in ("local_hits", "redis_hits", "misses"))
+            hits = self.__counters["local_hits"] + self.__counters["redis_hits"]
+            return {
+                "size": len(self.__entries),
+                "hit_ratio": hits / lookups if lookups else 0,
+                **self.__counters
+            }
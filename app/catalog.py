@@ -0,0 +1,114 @@
+"""Provide base class for in-process copies of the restaurant catalog.
+
+Every write to the restaurants collection increases a catalog version in
+redis. Mirrors patch themselves for writes of their own worker and rebuild
+from database when another worker changed the catalog.
+"""
+
+from threading import RLock
+from app import redis_db, nckufeed_db
+
+CATALOG_VERSION_KEY = "restaurants:catalog_version"
+
+catalog_mirrors = []
+
+
+def current_catalog_version() -> int:
+    """Get current catalog version from redis."""
+
+    return int(redis_db.get(CATALOG_VERSION_KEY) or 0)
+
+
+def notify_catalog_change(action: str, restaurant: dict):
+    """Increase catalog version and patch every mirror of this worker.
+
+    Args:
+        action (str): "add", "update" or "remove"
+        restaurant (dict): restaurant document with ``_id``, the document
+            after the change for "add" and "update"
+
+    """
+
+    version = redis_db.incr(CATALOG_VERSION_KEY)
+    for mirror in catalog_mirrors:
+        mirror.apply(version, action, restaurant)
+
+
+def bump_catalog_version():
+    """Increase catalog version after a bulk write, every mirror rebuilds
+    from database on next use instead of being patched per document.
+    """
+
+    redis_db.incr(CATALOG_VERSION_KEY)
+    for mirror in catalog_mirrors:
+        mirror.invalidate()
+
+
+class CatalogMirror:
+    """Base class of in-process structures built from the restaurants
+    collection. Subclasses implement ``_rebuild``, ``_add``, ``_update``
+    and ``_remove``, which are called with ``_lock`` held.
+    """
+
+    # Projection used when loading restaurants, None loads whole documents
+    projection = None
+
+    def __init__(self):
+        self._lock = RLock()
+        self._loaded = False
+        self._version = None
+        catalog_mirrors.append(self)
+
+    def _rebuild(self, restaurants):
+        raise NotImplementedError
+
+    def _add(self, restaurant: dict):
+        raise NotImplementedError
+
+    def _update(self, restaurant: dict):
+        raise NotImplementedError
+
+    def _remove(self, restaurant: dict):
+        raise NotImplementedError
+
+    def ensure_loaded(self):
+        """Rebuild from database if not loaded yet or the catalog version
+        changed. Callers should hold ``_lock``.
+        """
+
+        version = current_catalog_version()
+        if not self._loaded or self._version != version:
+            self._rebuild(nckufeed_db["restaurants"].find({}, self.projection))
+            self._version = version
+            self._loaded = True
+
+    def is_current(self) -> bool:
+        """Check if the mirror is loaded and up to date without loading it."""
+
+        return self._loaded and self._version == current_catalog_version()
+
+    def invalidate(self):
+        """Rebuild on next use."""
+
+        with self._lock:
+            self._loaded = False
+
+    def apply(self, version: int, action: str, restaurant: dict):
+        """Patch the mirror after a write of this worker.
+
+        Args:
+            version (int): catalog version after the write
+            action (str): "add", "update" or "remove"
+            restaurant (dict): restaurant document with ``_id``
+
+        """
+
+        with self._lock:
+            if not self._loaded:
+                return
+            if self._version != version - 1:
+                # Missed writes of other workers
+                self._loaded = False
+                return
+            self._version = version
+            getattr(self, "_" + action)(restaurant)
@@ -1,11 +1,15 @@
 """Provide api for user to create new comment to one restaurant."""
 
+from bson import ObjectId
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import jwt_required, get_jwt
 from app import api
 from app.models import Rating, Comment
 from app.utils import DatabaseProcessor
 
+DEFAULT_COMMENTS_LIMIT = 20
+MAX_COMMENTS_LIMIT = 100
+
 comments_args = reqparse.RequestParser()
 comments_args.add_argument("target_id", type=str, help="restaurant's id")
 comments_args.add_argument("id", type=str, help="comment's id")
@@ -13,6 +17,25 @@ comments_args.add_argument("content", type=str, help="comment's content")
 comments_args.add_argument("rating", type=int, action="append", location="json",
                         help="user's rating to a restaurant")
 
+def rating_from_args(rating: list) -> dict:
+    """Convert rating list in request to rating dict.
+
+    Args:
+        rating (list): cleanliness, service, deliciousness, CPR and overall
+
+    Return:
+        Rating dict.
+    """
+
+    return {
+        "cleanliness": rating[0],
+        "service": rating[1],
+        "deliciousness": rating[2],
+        "CPR": rating[3],
+        "overall": rating[4],
+    }
+
+
 class Comments(Resource):
     """The class provides POST, PUT and DELETE method
     to user to create or modify comments, and GET method
@@ -22,20 +45,37 @@ class Comments(Resource):
     database_processor = DatabaseProcessor()
 
     def get(self):
-        """GET method to get all comments.
+        """GET method to get comments, ``limit`` comments after comment
+        ``after`` at a time.
 
         Return:
-            List of comments and status code 200.
+            List of comments, id to pass as ``after`` for the next page
+            and status code 200.
         """
 
         parser = reqparse.RequestParser()
         parser.add_argument("target_id", type=str, location="args")
+        parser.add_argument("after", type=str, location="args", help="last comment's id of previous page")
+        parser.add_argument("limit", type=int, location="args", default=DEFAULT_COMMENTS_LIMIT)
+        parser.add_argument("fields", type=str, location="args",
+                            help="comma separated fields to return, e.g. content,rating")
         args = parser.parse_args()
-        result = self.database_processor.get_comment_from_restaurant_or_post(args.target_id)
-        if not result:
+        if args.after is not None and not ObjectId.is_valid(args.after):
+            return {"message": "invalid after."}, 400
+        limit = min(max(args.limit, 1), MAX_COMMENTS_LIMIT)
+        fields = [field.strip() for field in args.fields.split(",") if field.strip()] \
+            if args.fields else None
+        result = self.database_processor.get_comment_from_restaurant_or_post(
+            args.target_id,
+            after=args.after,
+            limit=limit,
+            fields=fields
+        )
+        if result is False:
             return {}, 500
         else:
-            return {"comments": result}, 200
+            next_after = result[-1]["_id"] if len(result) == limit else None
+            return {"comments": result, "next": next_after}, 200
 
     @jwt_required()
     def post(self):
@@ -49,13 +89,7 @@ class Comments(Resource):
         uid = get_jwt()["uid"]
         rating = Rating()
         if args.rating is not None:
-            rating = Rating(
-                cleanliness=args.rating[0],
-                service=args.rating[1],
-                deliciousness=args.rating[2],
-                CPR=args.rating[3],
-                overall=args.rating[4],
-            )
+            rating = Rating(**rating_from_args(args.rating))
         comment = Comment(
             uid=uid,
             target_id=args.target_id,
@@ -79,14 +113,21 @@ class Comments(Resource):
         """
 
         args = comments_args.parse_args()
-        json_input = {
-            "_id": args.id,
-            "content": args.content
-        }
-        if self.database_processor.update_comment_content(json_input):
-            return {}, 200
-        else:
-            return {}, 500
+        if args.content is not None:
+            json_input = {
+                "_id": args.id,
+                "content": args.content
+            }
+            if not self.database_processor.update_comment_content(json_input):
+                return {}, 500
+        if args.rating is not None:
+            json_input = {
+                "_id": args.id,
+                "rating": rating_from_args(args.rating)
+            }
+            if not self.database_processor.update_comment_rating(json_input):
+                return {}, 500
+        return {}, 200
 
     @jwt_required()
     def delete(self):
@@ -102,4 +143,28 @@ class Comments(Resource):
         else:
             return {}, 500
 
+class RatingSummary(Resource):
+    """The class provides GET method to get average ratings of restaurants
+    or posts without reading their comments.
+    """
+
+    database_processor = DatabaseProcessor()
+
+    def get(self):
+        """GET method to get rating summaries, ``target_id`` can be repeated.
+
+        Return:
+            Dict of target_id to number of ratings and average ratings.
+        """
+
+        parser = reqparse.RequestParser()
+        parser.add_argument("target_id", type=str, location="args", action="append", required=True)
+        args = parser.parse_args()
+        result = self.database_processor.get_rating_summaries(args.target_id)
+        if result is False:
+            return {}, 500
+        else:
+            return {"ratings": result}, 200
+
 api.add_resource(Comments, "/comments")
+api.add_resource(RatingSummary, "/comments/ratings")
@@ -0,0 +1,187 @@
+"""Provide a facet index of restaurants' region, time period and tags.
+
+Every restaurant gets a slot number, and every facet value keeps a bitmap of
+the slots having that value. Bitmaps are python integers, so filters are
+combined with bitwise and/or and counted with a popcount.
+"""
+
+import unicodedata
+from app.catalog import CatalogMirror
+from app.utils import serialize_restaurant
+
+FACET_FIELDS = ("region", "time_period", "tags")
+
+
+def normalize(text: str) -> str:
+    """Normalize full width characters and case."""
+
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def frontend_tag_values(frontend_tags) -> dict:
+    """Get values of frontend tags by key, values are lists of strings."""
+
+    if not isinstance(frontend_tags, dict):
+        return {}
+    values = {}
+    for key, value in frontend_tags.items():
+        if isinstance(value, (list, tuple)):
+            values[key] = [str(item) for item in value if item is not None]
+        elif value is not None:
+            values[key] = [str(value)]
+    return values
+
+
+def facet_values(record: dict) -> dict:
+    """Get facet values of a restaurant by facet field."""
+
+    values = frontend_tag_values(record.get("frontend_tags"))
+    return {
+        "region": values.get("region", []),
+        "time_period": values.get("time_period", []),
+        "tags": [str(tag) for tag in record.get("tags") or []]
+    }
+
+
+def popcount(bitmap: int) -> int:
+    return bin(bitmap).count("1")
+
+
+class FacetIndex(CatalogMirror):
+    """Bitmap index of facet values of the restaurants collection.
+    """
+
+    def __init__(self):
+        super(FacetIndex, self).__init__()
+        self.__reset()
+
+    def __reset(self):
+        self.__slots = {}
+        self.__records = []
+        self.__free_slots = []
+        self.__all = 0
+        self.__bitmaps = {field: {} for field in FACET_FIELDS}
+        self.__labels = {field: {} for field in FACET_FIELDS}
+
+    def __insert(self, record: dict):
+        if self.__free_slots:
+            slot = self.__free_slots.pop()
+            self.__records[slot] = record
+        else:
+            slot = len(self.__records)
+            self.__records.append(record)
+        self.__slots[record["_id"]] = slot
+        bit = 1 << slot
+        self.__all |= bit
+        for field, values in facet_values(record).items():
+            for value in values:
+                key = normalize(value)
+                self.__bitmaps[field][key] = self.__bitmaps[field].get(key, 0) | bit
+                self.__labels[field].setdefault(key, value)
+
+    def __delete(self, restaurant_id: str):
+        slot = self.__slots.pop(restaurant_id, None)
+        if slot is None:
+            return
+        record = self.__records[slot]
+        bit = 1 << slot
+        self.__all &= ~bit
+        for field, values in facet_values(record).items():
+            for value in values:
+                key = normalize(value)
+                bitmap = self.__bitmaps[field].get(key, 0) & ~bit
+                if bitmap:
+                    self.__bitmaps[field][key] = bitmap
+                else:
+                    self.__bitmaps[field].pop(key, None)
+                    self.__labels[field].pop(key, None)
+        self.__records[slot] = None
+        self.__free_slots.append(slot)
+
+    def _rebuild(self, restaurants):
+        self.__reset()
+        for restaurant in restaurants:
+            self.__insert(serialize_restaurant(restaurant))
+
+    def _add(self, restaurant: dict):
+        self._update(restaurant)
+
+    def _update(self, restaurant: dict):
+        record = serialize_restaurant(restaurant)
+        self.__delete(record["_id"])
+        self.__insert(record)
+
+    def _remove(self, restaurant: dict):
+        self.__delete(str(restaurant["_id"]))
+
+    def __field_bitmap(self, field: str, values: list):
+        """Or bitmaps of the values of one field, None if no value given."""
+
+        values = [value for value in values or [] if value]
+        if not values:
+            return None
+        bitmap = 0
+        for value in values:
+            bitmap |= self.__bitmaps[field].get(normalize(value), 0)
+        return bitmap
+
+    def __records_of(self, bitmap: int) -> list:
+        records = []
+        while bitmap:
+            lowest = bitmap & -bitmap
+            records.append(self.__records[lowest.bit_length() - 1])
+            bitmap ^= lowest
+        return records
+
+    def query(self, filters: dict, with_counts: bool = True):
+        """Find restaurants matching the filters.
+
+        Values of one field are combined with or, fields are combined
+        with and, e.g. ``{"region": ["東區", "北區"], "tags": ["Cafe"]}``
+        matches cafes in either region.
+
+        Args:
+            filters (dict): facet field to list of wanted values
+            with_counts (bool): also count restaurants of every facet value
+
+        Return:
+            Tuple of matched restaurants and facet counts. Counts of a field
+            apply the filters of the other fields only, so they tell how
+            many restaurants choosing that value would add.
+        """
+
+        with self._lock:
+            self.ensure_loaded()
+            field_bitmaps = {field: self.__field_bitmap(field, filters.get(field))
+                             for field in FACET_FIELDS}
+            matched = self.__all
+            for bitmap in field_bitmaps.values():
+                if bitmap is not None:
+                    matched &= bitmap
+
+            counts = {}
+            if with_counts:
+                for field in FACET_FIELDS:
+                    base = self.__all
+                    for other, bitmap in field_bitmaps.items():
+                        if other != field and bitmap is not None:
+                            base &= bitmap
+                    counts[field] = {}
+                    for key, bitmap in self.__bitmaps[field].items():
+                        count = popcount(bitmap & base)
+                        if count:
+                            counts[field][self.__labels[field][key]] = count
+            return self.__records_of(matched), counts
+
+    def match_ids(self, filters: dict):
+        """Get ids of restaurants matching the filters, None if no filter
+        is given.
+        """
+
+        if all(not any(filters.get(field) or []) for field in FACET_FIELDS):
+            return None
+        records, _ = self.query(filters, with_counts=False)
+        return {record["_id"] for record in records}
+
+
+facet_index = FacetIndex()
@@ -1,6 +1,6 @@
 from app import app, nckufeed_db
 from app.models import Restaurant, User
-from app.utils import create_user_hmap, RecommendComputeTask
+from app.utils import create_user_hmap, compute_recommend_list
 from app.utils import DatabaseProcessor
 from bson.objectid import ObjectId
 import pandas as pd
@@ -0,0 +1,198 @@
+"""Declare, create and verify indexes of every collection.
+
+Usage:
+    python -m app.index_manager [--check] [--explain]
+
+Without options, missing indexes are created. ``--check`` reports missing
+indexes and indexes which are not declared or never used since the server
+started. ``--explain`` runs ``explain`` on the queries of
+``DatabaseProcessor`` and reports those which scan the whole collection.
+Indexes are also created when the server starts.
+"""
+
+import argparse
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from app import nckufeed_db
+
+# Collection name to list of (keys, options) of its indexes
+INDEXES = {
+    "restaurants": [
+        # Upsert key of rows without _id in bulk import
+        ([("name", ASCENDING), ("address", ASCENDING)], {}),
+    ],
+    "users": [
+        ([("uid", ASCENDING)], {}),
+    ],
+    "comments": [
+        ([("target_id", ASCENDING), ("_id", ASCENDING)], {}),
+    ],
+    "rating_summary": [
+        ([("target_id", ASCENDING)], {"unique": True}),
+    ],
+    "posts": [
+        ([("release_time", DESCENDING), ("_id", DESCENDING)], {}),
+        ([("restaurants_id", ASCENDING), ("release_time", DESCENDING), ("_id", DESCENDING)], {}),
+        ([("uid", ASCENDING), ("release_time", DESCENDING), ("_id", DESCENDING)], {}),
+    ],
+    "recommend_list": [
+        ([("uid", ASCENDING), ("page", ASCENDING)], {"unique": True}),
+    ],
+}
+
+# Shapes of queries of DatabaseProcessor and the api, as
+# (collection, filter, sort), values are placeholders
+QUERIES = [
+    ("users", {"uid": ""}, None),
+    ("users", {"uid": {"$in": [""]}}, None),
+    ("restaurants", {"_id": ObjectId()}, None),
+    ("restaurants", {"_id": {"$in": [ObjectId()]}}, None),
+    ("restaurants", {"name": "", "address": ""}, None),
+    ("comments", {"_id": ObjectId()}, None),
+    ("comments", {"target_id": ""}, [("_id", ASCENDING)]),
+    ("comments", {"target_id": "", "_id": {"$gt": ObjectId()}}, [("_id", ASCENDING)]),
+    ("rating_summary", {"target_id": {"$in": [""]}}, None),
+    ("posts", {"_id": ObjectId()}, None),
+    ("posts", {"uid": ""}, None),
+    ("posts", {"restaurants_id": ""}, None),
+    ("posts", {}, [("release_time", DESCENDING), ("_id", DESCENDING)]),
+    ("posts", {"restaurants_id": ""}, [("release_time", DESCENDING), ("_id", DESCENDING)]),
+    ("posts", {"uid": ""}, [("release_time", DESCENDING), ("_id", DESCENDING)]),
+    ("recommend_list", {"uid": "", "page": 1}, None),
+    ("recommend_list", {"uid": "", "page": {"$gt": 1}}, None),
+]
+
+
+def key_of(keys) -> tuple:
+    """Normalize index keys, e.g. from ``index_information``, for comparing.
+    Directions are kept as they are, they may be "text", "2dsphere" or
+    "hashed", and numbers compare equal whether int or float.
+    """
+
+    return tuple((field, direction) for field, direction in keys)
+
+
+def ensure_indexes(database=nckufeed_db) -> list:
+    """Create declared indexes which don't exist yet.
+
+    Return:
+        List of (collection, index name) of indexes which could not be
+        created, e.g. because another index with the same keys and other
+        options exists.
+    """
+
+    failed = []
+    for collection_name, indexes in INDEXES.items():
+        collection = database[collection_name]
+        for keys, options in indexes:
+            try:
+                collection.create_index(keys, **options)
+            except OperationFailure as error:
+                print("create index on %s failed: %s" % (collection_name, error))
+                failed.append((collection_name, keys))
+    return failed
+
+
+def index_usage(collection) -> dict:
+    """Get number of operations using each index since the server started.
+
+    Return:
+        Dict of index name to count, empty if ``$indexStats`` is not
+        supported.
+    """
+
+    try:
+        return {stats["name"]: stats["accesses"]["ops"]
+                for stats in collection.aggregate([{"$indexStats": {}}])}
+    except OperationFailure:
+        return {}
+
+
+def check_indexes(database=nckufeed_db) -> dict:
+    """Compare existing indexes with declared ones.
+
+    Return:
+        Dict with lists of "missing" and "undeclared" indexes as
+        (collection, keys), and "unused" declared indexes as
+        (collection, index name).
+    """
+
+    report = {"missing": [], "undeclared": [], "unused": []}
+    for collection_name in sorted(set(INDEXES) | set(database.list_collection_names())):
+        collection = database[collection_name]
+        declared = {key_of(keys) for keys, _ in INDEXES.get(collection_name, [])}
+        existing = {key_of(info["key"]): name
+                    for name, info in collection.index_information().items()
+                    if name != "_id_"}
+        usage = index_usage(collection)
+        for key in declared - set(existing):
+            report["missing"].append((collection_name, list(key)))
+        for key, name in existing.items():
+            if key not in declared:
+                report["undeclared"].append((collection_name, list(key)))
+            elif usage.get(name) == 0:
+                report["unused"].append((collection_name, name))
+    return report
+
+
+def plan_stages(plan: dict) -> list:
+    """Get stage names of a query plan and all of its input stages."""
+
+    stages = [plan.get("stage")]
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            stages.extend(plan_stages(child))
+    return stages
+
+
+def explain_queries(database=nckufeed_db) -> list:
+    """Explain every query shape in ``QUERIES``.
+
+    Return:
+        List of (collection, filter, sort, stages of the winning plan) of
+        queries which are not served by an index.
+    """
+
+    collection_scans = []
+    for collection_name, query, sort in QUERIES:
+        cursor = database[collection_name].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        stages = plan_stages(plan.get("queryPlan", plan))
+        if "COLLSCAN" in stages or "SORT" in stages:
+            collection_scans.append((collection_name, query, sort, stages))
+    return collection_scans
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create and verify indexes.")
+    parser.add_argument("--check", action="store_true",
+                        help="report missing, undeclared and unused indexes")
+    parser.add_argument("--explain", action="store_true",
+                        help="report queries which are not served by an index")
+    args = parser.parse_args()
+
+    if not args.check and not args.explain:
+        failed = ensure_indexes()
+        print("Created indexes, %d failed" % len(failed))
+        return
+    ok = True
+    if args.check:
+        report = check_indexes()
+        for kind, indexes in report.items():
+            for collection_name, index in indexes:
+                print("%s index on %s: %s" % (kind, collection_name, index))
+        ok = not report["missing"]
+    if args.explain:
+        for collection_name, query, sort, stages in explain_queries():
+            print("not index backed on %s: %s sort %s -> %s"
+                  % (collection_name, query, sort, " <- ".join(stages)))
+            ok = False
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
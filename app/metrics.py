@@ -0,0 +1,67 @@
+"""Provide api to expose runtime counters of caches and background workers."""
+
+from collections import deque
+from threading import Lock
+from flask_restful import Resource
+from app import api
+
+metrics_providers = {}
+
+
+def register_metrics(name: str, provider):
+    """Register a function which returns a dict of counters.
+
+    Args:
+        name (str): key of the counters in the response
+        provider (callable): function without arguments returning a dict
+
+    """
+
+    metrics_providers[name] = provider
+
+
+class LatencyRecorder:
+    """Keep latencies of recent requests and report their percentiles.
+    """
+
+    def __init__(self, size: int = 1000):
+        self.__latencies = deque(maxlen=size)
+        self.__lock = Lock()
+
+    def record(self, seconds: float):
+        with self.__lock:
+            self.__latencies.append(seconds)
+
+    def stats(self) -> dict:
+        """Get p50, p90 and p99 of recent latencies in milliseconds."""
+
+        with self.__lock:
+            latencies = sorted(self.__latencies)
+        if not latencies:
+            return {"count": 0}
+
+        def percentile(p):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 3)
+
+        return {
+            "count": len(latencies),
+            "p50_ms": percentile(0.5),
+            "p90_ms": percentile(0.9),
+            "p99_ms": percentile(0.99)
+        }
+
+
+class Metrics(Resource):
+    """The class provide GET for operators to read runtime counters.
+    """
+
+    def get(self):
+        """GET method to get all registered counters.
+
+        Return:
+            Counters of every registered component.
+        """
+
+        return {name: provider() for name, provider in metrics_providers.items()}, 200
+
+api.add_resource(Metrics, "/metrics")
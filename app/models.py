@@ -1,7 +1,7 @@
 """Provide data model for database."""
 
 from typing import List, Optional
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
 from pydantic import BaseModel, Field, validator
 
 class Rating(BaseModel):
@@ -46,6 +46,17 @@ class Restaurant(BaseModel):
             return []
         return value
 
+class RestaurantSummary(BaseModel):
+    """Restaurant fields shown in lists, full info is from restaurant api.
+    """
+
+    restaurant_id: str = Field(alias="_id")
+    name: str
+    star: float = 0
+    photo: Optional[str] = None
+    tags: List[str] = Field(default_factory=list)
+    region: Optional[str] = None
+
 class User(BaseModel):
     """User model.
     """
@@ -66,6 +77,16 @@ class RecommendList(BaseModel):
     page: int
     recommendation: List[Restaurant]
 
+class RankedRecommendList(BaseModel):
+    """Compact recommend list model. Only stores ranked restaurants' id
+    and similarity of one page, restaurants are loaded when reading.
+    """
+
+    uid: str
+    page: int
+    restaurants_id: List[str]
+    scores: List[float] = Field(default_factory=list)
+
 class Post(BaseModel):
     """Post model.
     """
@@ -75,4 +96,5 @@ class Post(BaseModel):
     content: str # includes picture url
     restaurants_id: str
     like: int = Field(default=0, ge=0)
-    release_time: str = datetime.now(timezone(timedelta(hours=+8))).strftime("%Y-%m-%d, %H:%M:%S")
+    # Set when the post is created, stored as a UTC date
+    release_time: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
@@ -1,10 +1,18 @@
 """Provide api for user to create new posts."""
 
+import base64
+import binascii
+import json
+from datetime import datetime
+from bson import ObjectId
 from flask_restful import Resource, reqparse
 from flask_jwt_extended import jwt_required, get_jwt
 from app import api
 from app.models import Post
-from app.utils import DatabaseProcessor
+from app.utils import DatabaseProcessor, build_update, serialize_post
+
+DEFAULT_FEED_LIMIT = 20
+MAX_FEED_LIMIT = 100
 
 posts_args = reqparse.RequestParser()
 posts_args.add_argument("title", type=str)
@@ -42,27 +50,16 @@ class Posts(Resource):
             comments_id=[]
         )
         if self.database_processor.insert_post(new_post.dict()):
-            return new_post.dict(), 201
+            return serialize_post(new_post.dict()), 201
         else:
             return {}, 500
 
     @jwt_required()
     def put(self):
         args = posts_args.parse_args()
-        if args.content is not None:
-            json_input = {
-                "_id": args.id,
-                "content": args.content,
-            }
-            if not self.database_processor.update_post_content(json_input):
-                return {"message": "update post's content error."}, 500
-        if args.title is not None:
-            json_input = {
-                "_id": args.id,
-                "title": args.title,
-            }
-            if not self.database_processor.update_post_title(json_input):
-                return {"message": "update post's title error."}, 500
+        update = build_update(set_fields={"content": args.content, "title": args.title})
+        if not self.database_processor.patch_post(args.id, update):
+            return {"message": "update post error."}, 500
         if args.like is not None:
             json_input = {
                 "_id": args.id,
@@ -70,6 +67,7 @@ class Posts(Resource):
             }
             if not self.database_processor.update_post_like(json_input):
                 return {"message": "update post's like error."}, 500
+        return {}, 200
 
     @jwt_required()
     def delete(self):
@@ -108,6 +106,71 @@ class RestaurantPosts(Resource):
             return post, 200
 
 
+def encode_feed_cursor(post: dict) -> str:
+    """Encode position of the last post of a page, serialized with
+    ``serialize_post``, into an opaque token.
+    """
+
+    position = {"release_time": post["release_time"], "id": post["_id"]}
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_feed_cursor(token: str):
+    """Decode token from ``encode_feed_cursor``.
+
+    Return:
+        Tuple of release_time as datetime and post's _id, None if the token
+        is invalid.
+    """
+
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode()))
+        before = (datetime.fromisoformat(position["release_time"]), str(position["id"]))
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        return None
+    return before if ObjectId.is_valid(before[1]) else None
+
+
+class PostFeed(Resource):
+    """The class provides GET method to get newest posts page by page,
+    of everyone, a restaurant or a user.
+    """
+
+    database_processor = DatabaseProcessor()
+
+    def get(self):
+        """GET method to get one page of posts, newest first.
+
+        Return:
+            List of posts and token of the next page, None if there is no
+            next page.
+        """
+
+        parser = reqparse.RequestParser()
+        parser.add_argument("restaurant_id", type=str, location="args")
+        parser.add_argument("uid", type=str, location="args")
+        parser.add_argument("limit", type=int, location="args", default=DEFAULT_FEED_LIMIT)
+        parser.add_argument("next", type=str, location="args")
+        args = parser.parse_args()
+        before = None
+        if args.next:
+            before = decode_feed_cursor(args.next)
+            if before is None:
+                return {"message": "invalid next token."}, 400
+        limit = min(max(args.limit, 1), MAX_FEED_LIMIT)
+        posts = self.database_processor.get_post_feed(
+            restaurant_id=args.restaurant_id,
+            uid=args.uid,
+            before=before,
+            limit=limit
+        )
+        if posts is False:
+            return {}, 500
+        next_token = encode_feed_cursor(posts[-1]) if len(posts) == limit else None
+        return {"posts": posts, "next": next_token}, 200
+
+
 api.add_resource(Posts, "/posts")
 api.add_resource(UserPosts, "/posts/user")
 api.add_resource(RestaurantPosts, "/posts/restaurant")
+api.add_resource(PostFeed, "/posts/feed")
@@ -0,0 +1,20 @@
+"""Rebuild rating summaries of every restaurant and post from comments.
+
+Usage:
+    python -m app.ratings
+
+Summaries are kept up to date by ``DatabaseProcessor`` when comments are
+created, edited or deleted. Run this once for comments created before
+summaries existed, or to repair them.
+"""
+
+from app.utils import DatabaseProcessor
+
+
+def main():
+    count = DatabaseProcessor().rebuild_rating_summaries()
+    print("Rebuilt rating summaries of %d targets" % count)
+
+
+if __name__ == "__main__":
+    main()
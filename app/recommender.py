@@ -3,13 +3,18 @@
 from flask_restful import Resource
 from flask_jwt_extended import get_jwt, jwt_required
 from app import nckufeed_db, api
-from app.models import RecommendList
+from app.utils import DatabaseProcessor, RecomputeJob, random_pools, recommend_on_the_fly, \
+    summarize_restaurant
+
+RANDOM_RECOMMEND_SIZE = 100
 
 
 class Recommender(Resource):
     """The class provide GET for frontend to get recommend list.
     """
 
+    database_processor = DatabaseProcessor()
+
     @jwt_required()
     def get(self, page):
         """GET method to get recommend list from database.
@@ -20,21 +25,62 @@ class Recommender(Resource):
 
         uid = get_jwt()["uid"]
         recommend_list_collection = nckufeed_db["recommend_list"]
-        user_recommendation = list(
-            recommend_list_collection.find(
-                {
-                    "uid": uid,
-                    "page": int(page)
-                },
-                { "_id": 0 }
-            )
-        )
-        recommend_list = RecommendList(
-            uid=uid,
-            page=page,
-            recommendation=user_recommendation[0]["recommendation"]
+        user_recommendation = recommend_list_collection.find_one(
+            {
+                "uid": uid,
+                "page": int(page)
+            },
+            # Only fields of restaurant summaries, for lists of whole restaurants
+            {
+                "_id": 0,
+                "restaurants_id": 1,
+                "recommendation._id": 1,
+                "recommendation.name": 1,
+                "recommendation.star": 1,
+                "recommendation.photos": 1,
+                "recommendation.tags": 1,
+                "recommendation.frontend_tags.region": 1
+            }
         )
-        return recommend_list.dict(by_alias=True), 200
+        if user_recommendation is None:
+            # Recommend list is not computed yet, compute this page directly
+            recommendation = [summarize_restaurant(restaurant)
+                              for restaurant in recommend_on_the_fly(uid, int(page))]
+        elif "restaurants_id" in user_recommendation:
+            # Compact recommend list, load restaurants of this page
+            recommendation = self.database_processor.get_restaurants(
+                user_recommendation["restaurants_id"],
+                summary=True
+            )
+            if recommendation is False:
+                return {}, 500
+        else:
+            recommendation = [summarize_restaurant(restaurant)
+                              for restaurant in user_recommendation.get("recommendation", [])]
+        return {
+            "uid": uid,
+            "page": int(page),
+            "recommendation": recommendation
+        }, 200
+
+
+class RecomputeStatus(Resource):
+    """The class provide GET for frontend to check whether the recommend
+    list computation is finished.
+    """
+
+    @jwt_required()
+    def get(self, job_id):
+        """GET method to get status of a recompute job.
+
+        Return:
+            Status of the job, one of pending, running, done and failed.
+        """
+
+        job = RecomputeJob.get_status(job_id)
+        if not job or job["uid"] != get_jwt()["uid"]:
+            return {}, 404
+        return { "job_id": job_id, "status": job["status"] }, 200
 
 
 class RandomRecommender(Resource):
@@ -43,23 +89,16 @@ class RandomRecommender(Resource):
     """
 
     def get(self):
-        """GET method to get random recommend list from database.
+        """GET method to get random recommend list from precomputed pools.
 
         Return:
             List of random recommendation.
         """
 
-        restaurants_collection = nckufeed_db["restaurants"]
-        random_recommendation = list(
-            restaurants_collection.aggregate(
-                [
-                    { "$sample": { "size": 100 } }
-                ]
-            )
-        )
-        for recommendation in random_recommendation:
-            recommendation["_id"] = str(recommendation["_id"])
+        # Served from pools reshuffled by random_pool_refresher
+        random_recommendation = random_pools.pick(RANDOM_RECOMMEND_SIZE)
         return { "random_recommendation": random_recommendation }, 200
 
 api.add_resource(Recommender, "/recommend/<string:page>")
+api.add_resource(RecomputeStatus, "/recompute/<string:job_id>")
 api.add_resource(RandomRecommender, "/randomRecommend")
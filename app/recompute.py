@@ -0,0 +1,78 @@
+"""Recompute recommend lists of all users at once.
+
+Usage:
+    python -m app.recompute [--chunk-size N]
+
+Similarity of a chunk of users is computed with one matrix product against
+the restaurants' tag matrix, then their recommend lists are written with
+bulk writes of about ``MAX_PENDING_RECOMMEND_WRITES`` pages. Users whose
+preferences changed recently are handled by ``DirtyUserRecomputer`` instead.
+"""
+
+import argparse
+import time
+import numpy as np
+from app import nckufeed_db
+from app.utils import preference_vector, update_recommend_lists, restaurant_features
+
+# Upper bound of similarity elements held in memory for one chunk (64 MB of float32)
+MAX_CHUNK_ELEMENTS = 16 * 1024 * 1024
+
+
+def iter_user_chunks(chunk_size: int):
+    """Read users' preferences in chunks.
+
+    Args:
+        chunk_size (int): number of users in one chunk
+
+    Yield:
+        List of uids and their preference matrix.
+    """
+
+    uids, preferences = [], []
+    cursor = nckufeed_db["users"].find({}, {"_id": 0, "uid": 1, "preference": 1},
+                                       batch_size=chunk_size)
+    for user in cursor:
+        uids.append(user["uid"])
+        preferences.append(preference_vector(user.get("preference") or []))
+        if len(uids) == chunk_size:
+            yield uids, np.vstack(preferences)
+            uids, preferences = [], []
+    if uids:
+        yield uids, np.vstack(preferences)
+
+
+def recompute_all(chunk_size: int = None) -> int:
+    """Recompute recommend lists of every user.
+
+    Args:
+        chunk_size (int): number of users per matrix product, derived from
+            the number of restaurants if not given
+
+    Return:
+        Number of users recomputed.
+    """
+
+    restaurants, _ = restaurant_features.snapshot()
+    if chunk_size is None:
+        chunk_size = max(1, min(1000, MAX_CHUNK_ELEMENTS // max(1, len(restaurants))))
+    count = 0
+    for uids, preferences in iter_user_chunks(chunk_size):
+        update_recommend_lists(uids, preferences)
+        count += len(uids)
+        print("Recomputed", count, "users")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompute recommend lists of all users.")
+    parser.add_argument("--chunk-size", type=int, default=None,
+                        help="number of users computed in one matrix product")
+    args = parser.parse_args()
+    start = time.perf_counter()
+    count = recompute_all(args.chunk_size)
+    print("Recomputed %d users in %.1f seconds" % (count, time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+"""Convert release_time of old posts to dates.
+
+Usage:
+    python -m app.release_times
+
+Posts used to store release_time as a "%Y-%m-%d, %H:%M:%S" string in UTC+8.
+New posts store a UTC date, and strings sort apart from dates in database,
+so run this once after upgrading to page old and new posts together.
+"""
+
+from app.utils import DatabaseProcessor
+
+
+def main():
+    count = DatabaseProcessor().convert_release_times()
+    print("Converted release_time of %d posts" % count)
+
+
+if __name__ == "__main__":
+    main()
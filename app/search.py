@@ -1,7 +1,61 @@
 """Provide api to get search restaurants."""
 
+import base64
+import binascii
+import json
+import time
+from flask import Response
 from flask_restful import Resource, reqparse
-from app import nckufeed_db, api
+from app import app, api
+from app.cache import TwoTierCache
+from app.catalog import current_catalog_version
+from app.metrics import LatencyRecorder, register_metrics
+from app.facets import facet_index
+from app.search_engine import search_engine, words_of, normalize
+from app.utils import summarize_restaurant
+
+MAX_SEARCH_LIMIT = 100
+
+search_cache = TwoTierCache("search_cache",
+                            app.config["SEARCH_CACHE_TTL"],
+                            max_size=app.config["SEARCH_CACHE_SIZE"])
+search_latency = LatencyRecorder()
+register_metrics("search_latency", search_latency.stats)
+
+
+def search_cache_key(search_name: str, search_region: str, search_time: str, *page) -> str:
+    """Build cache key of a search, queries differing only in case, width or
+    punctuation share the key. The catalog version is part of the key, so
+    results cached before a catalog change are not used.
+    """
+
+    return json.dumps([
+        current_catalog_version(),
+        " ".join(words_of(search_name or "")),
+        normalize(search_region or "").strip(),
+        normalize(search_time or "").strip(),
+        *page
+    ], ensure_ascii=False)
+
+
+def encode_cursor(offset: int) -> str:
+    """Encode position of the next page into an opaque token."""
+
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode()).decode()
+
+
+def decode_cursor(token: str) -> int:
+    """Decode token from ``encode_cursor``.
+
+    Return:
+        Offset of the next page, None if the token is invalid.
+    """
+
+    try:
+        offset = json.loads(base64.urlsafe_b64decode(token.encode()))["offset"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        return None
+    return offset if isinstance(offset, int) and offset >= 0 else None
 
 
 class Search(Resource):
@@ -12,48 +66,95 @@ class Search(Resource):
         """GET method to get search results.
 
         Return:
-            List of searching items.
+            List of searching items and token of the next page, None if
+            there is no next page.
         """
 
+        start = time.perf_counter()
         parser = reqparse.RequestParser()
         parser.add_argument("search_name", type=str, location="args", required=True)
         parser.add_argument("search_region", type=str, location="args", required=True)
         parser.add_argument("search_time", type=str, location="args", required=True)
+        parser.add_argument("limit", type=int, location="args", default=MAX_SEARCH_LIMIT)
+        parser.add_argument("next", type=str, location="args")
+        parser.add_argument("fields", type=str, location="args",
+                            help="comma separated fields of restaurant summaries to "
+                                 "return, e.g. name,star")
         args = parser.parse_args()
-        print(args.search_name, args.search_region, args.search_time)
-
-        restaurants_collection = nckufeed_db["restaurants"]
-        results = list(
-            restaurants_collection.aggregate(
-                [
-                    {
-                        "$search": {
-                            "index": "searchRestaurants",
-                            "text": {
-                                "query": "{\
-                                    \"name\": {\"$eq\": %s},\
-                                    \"frontend_tags\": {\
-                                        \"region\": {\"$eq\": %s},\
-                                        \"time_period\": {\"$eq\": %s}\
-                                    }\
-                                }" % (args.search_name, args.search_region, args.search_time),
-                                "path": {
-                                    "wildcard": "*"
-                                },
-                                "fuzzy": {
-                                    "maxEdits": 2
-                                }
-                            }
-                        }
-                    },
-                    {
-                        "$limit": 100
-                    }
-                ]
+
+        limit = min(max(args.limit, 1), MAX_SEARCH_LIMIT)
+        offset = 0
+        if args.next:
+            offset = decode_cursor(args.next)
+            if offset is None:
+                return {"message": "invalid next token."}, 400
+        fields = sorted({field.strip() for field in args.fields.split(",") if field.strip()}) \
+            if args.fields else None
+
+        def run_search(_):
+            # Ask for one more result to know if there is a next page
+            results = search_engine.search(
+                args.search_name,
+                limit=limit + 1,
+                offset=offset,
+                region=args.search_region,
+                time_period=args.search_time
             )
-        )
-        for result in results:
-            result["_id"] = str(result["_id"])
-        return { "result": results }, 200
+            results = [summarize_restaurant(result) for result in results]
+            if fields:
+                keys = set(fields) | {"_id"}
+                results = [{key: value for key, value in result.items() if key in keys}
+                           for result in results]
+            next_token = encode_cursor(offset + limit) if len(results) > limit else None
+            return json.dumps({ "result": results[:limit], "next": next_token })
+
+        key = search_cache_key(args.search_name, args.search_region, args.search_time,
+                               offset, limit, fields)
+        payload = search_cache.get(key, run_search)
+        search_latency.record(time.perf_counter() - start)
+        return Response(payload, status=200, mimetype="application/json")
+
+class Browse(Resource):
+    """The class provide GET for users to browse restaurants by region,
+    time period and tags, with number of restaurants of every facet value.
+    """
+
+    def get(self):
+        """GET method to get filtered restaurants.
+
+        Return:
+            List of restaurants ordered by star, token of the next page and
+            facet counts.
+        """
+
+        parser = reqparse.RequestParser()
+        parser.add_argument("region", type=str, location="args", action="append")
+        parser.add_argument("time_period", type=str, location="args", action="append")
+        parser.add_argument("tags", type=str, location="args", action="append")
+        parser.add_argument("limit", type=int, location="args", default=MAX_SEARCH_LIMIT)
+        parser.add_argument("next", type=str, location="args")
+        args = parser.parse_args()
+
+        limit = min(max(args.limit, 1), MAX_SEARCH_LIMIT)
+        offset = 0
+        if args.next:
+            offset = decode_cursor(args.next)
+            if offset is None:
+                return {"message": "invalid next token."}, 400
+
+        restaurants, facets = facet_index.query({
+            "region": args.region,
+            "time_period": args.time_period,
+            "tags": args.tags
+        })
+        restaurants.sort(key=lambda restaurant: (-restaurant["star"], restaurant["_id"]))
+        next_token = encode_cursor(offset + limit) if len(restaurants) > offset + limit else None
+        return {
+            "result": [summarize_restaurant(restaurant)
+                       for restaurant in restaurants[offset:offset + limit]],
+            "next": next_token,
+            "facets": facets
+        }, 200
 
 api.add_resource(Search, "/search")
+api.add_resource(Browse, "/browse")
@@ -0,0 +1,286 @@
+"""Provide an in-process search engine of restaurants.
+
+Names, tags and frontend tags are indexed in an inverted index of whole
+words and character bigrams, so both english words and chinese names can be
+matched partially. Query words are also matched to indexed words within a
+bounded edit distance, candidates are found through bigrams of the indexed
+words first so edit distance is only computed for a few of them. Region and
+time period are exact filters served by the facet index.
+"""
+
+from bisect import bisect_left, insort
+from collections import defaultdict
+import heapq
+import re
+from app.catalog import CatalogMirror
+from app.facets import facet_index, frontend_tag_values, normalize
+from app.utils import serialize_restaurant
+
+WORD_PATTERN = re.compile(r"\w+")
+
+# Weight of a match in each field
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "tags": 1.0,
+    "frontend_tags": 1.0
+}
+
+
+def words_of(text: str) -> list:
+    """Split text into normalized words."""
+
+    return WORD_PATTERN.findall(normalize(text))
+
+
+def bigrams_of(word: str) -> list:
+    """Get character bigrams of a non ascii word, e.g. a chinese name which
+    is not split by spaces. Ascii words are matched as whole words instead.
+    """
+
+    if word.isascii():
+        return []
+    if len(word) < 2:
+        return [word]
+    return [word[i:i + 2] for i in range(len(word) - 1)]
+
+
+def max_edits_of(word: str) -> int:
+    """Allowed edit distance of a query word, short words must match exactly."""
+
+    if len(word) < 3:
+        return 0
+    if len(word) < 6:
+        return 1
+    return 2
+
+
+def padded_bigrams_of(word: str) -> set:
+    """Get bigrams of a word with its start and end marked, e.g. "^c", "ca",
+    "af", "fe", "e$" for "cafe". One edit changes at most two of them.
+    """
+
+    padded = "^" + word + "$"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+def edit_distance(source: str, target: str, limit: int) -> int:
+    """Levenshtein distance of two words, stops early once over ``limit``.
+
+    Return:
+        The distance, or ``limit + 1`` if it is larger than ``limit``.
+    """
+
+    if abs(len(source) - len(target)) > limit:
+        return limit + 1
+    previous = list(range(len(target) + 1))
+    for i, source_char in enumerate(source, start=1):
+        current = [i]
+        for j, target_char in enumerate(target, start=1):
+            current.append(min(previous[j] + 1,
+                               current[j - 1] + 1,
+                               previous[j - 1] + (source_char != target_char)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+class RestaurantSearchEngine(CatalogMirror):
+    """Inverted index of the restaurants collection.
+    """
+
+    def __init__(self):
+        super(RestaurantSearchEngine, self).__init__()
+        self.__records = {}
+        self.__terms = {}
+        self.__postings = defaultdict(dict)
+        self.__words_by_length = defaultdict(set)
+        self.__words_by_gram = defaultdict(set)
+        self.__sorted_words = []
+
+    def __add_word(self, word: str):
+        self.__words_by_length[len(word)].add(word)
+        for gram in padded_bigrams_of(word):
+            self.__words_by_gram[gram].add(word)
+        insort(self.__sorted_words, word)
+
+    def __discard_word(self, word: str):
+        self.__words_by_length[len(word)].discard(word)
+        for gram in padded_bigrams_of(word):
+            words = self.__words_by_gram[gram]
+            words.discard(word)
+            if not words:
+                del self.__words_by_gram[gram]
+        i = bisect_left(self.__sorted_words, word)
+        if i < len(self.__sorted_words) and self.__sorted_words[i] == word:
+            del self.__sorted_words[i]
+
+    def __index_terms(self, record: dict) -> dict:
+        """Get terms of a restaurant and their weight."""
+
+        texts = [("name", record.get("name") or "")]
+        texts.extend(("tags", tag) for tag in record.get("tags") or [])
+        for values in frontend_tag_values(record.get("frontend_tags")).values():
+            texts.extend(("frontend_tags", value) for value in values)
+
+        terms = {}
+        for field, text in texts:
+            weight = FIELD_WEIGHTS[field]
+            for word in words_of(text):
+                # Single characters are indexed too, for one character queries
+                grams = bigrams_of(word) + ([] if word.isascii() else list(word))
+                for term in [("word", word)] + [("gram", gram) for gram in grams]:
+                    terms[term] = max(terms.get(term, 0), weight)
+        return terms
+
+    def __insert(self, record: dict):
+        restaurant_id = record["_id"]
+        terms = self.__index_terms(record)
+        for term, weight in terms.items():
+            if term[0] == "word" and term not in self.__postings:
+                self.__add_word(term[1])
+            self.__postings[term][restaurant_id] = weight
+        self.__records[restaurant_id] = record
+        self.__terms[restaurant_id] = terms
+
+    def __delete(self, restaurant_id: str):
+        record = self.__records.pop(restaurant_id, None)
+        if record is None:
+            return
+        for term in self.__terms.pop(restaurant_id):
+            postings = self.__postings[term]
+            postings.pop(restaurant_id, None)
+            if not postings:
+                del self.__postings[term]
+                if term[0] == "word":
+                    self.__discard_word(term[1])
+
+    def _rebuild(self, restaurants):
+        self.__records = {}
+        self.__terms = {}
+        self.__postings = defaultdict(dict)
+        self.__words_by_length = defaultdict(set)
+        self.__words_by_gram = defaultdict(set)
+        self.__sorted_words = []
+        for restaurant in restaurants:
+            self.__insert(serialize_restaurant(restaurant))
+
+    def _add(self, restaurant: dict):
+        self._update(restaurant)
+
+    def _update(self, restaurant: dict):
+        record = serialize_restaurant(restaurant)
+        self.__delete(record["_id"])
+        self.__insert(record)
+
+    def _remove(self, restaurant: dict):
+        self.__delete(str(restaurant["_id"]))
+
+    def __similar_words(self, word: str) -> dict:
+        """Find indexed words within the allowed edit distance of a word.
+
+        Return:
+            Dict of indexed word to its edit distance.
+        """
+
+        limit = max_edits_of(word)
+        similar = {}
+        # Longer words only match as prefix, e.g. "starbuck" for "starbucks"
+        if len(word) >= 3:
+            i = bisect_left(self.__sorted_words, word)
+            while i < len(self.__sorted_words) and self.__sorted_words[i].startswith(word):
+                candidate = self.__sorted_words[i]
+                if len(candidate) > len(word) + limit:
+                    similar[candidate] = 1
+                i += 1
+        if limit == 0:
+            if ("word", word) in self.__postings:
+                similar[word] = 0
+            return similar
+
+        # Words within the distance share all but 2 * limit bigrams
+        grams = padded_bigrams_of(word)
+        min_shared = len(grams) - 2 * limit
+        if min_shared > 0:
+            shared = defaultdict(int)
+            for gram in grams:
+                for candidate in self.__words_by_gram.get(gram, ()):
+                    shared[candidate] += 1
+            candidates = [candidate for candidate, count in shared.items() if count >= min_shared]
+        else:
+            candidates = [candidate for length in range(len(word) - limit, len(word) + limit + 1)
+                          for candidate in self.__words_by_length.get(length, ())]
+        for candidate in candidates:
+            if abs(len(candidate) - len(word)) <= limit:
+                distance = edit_distance(word, candidate, limit)
+                if distance <= limit:
+                    similar[candidate] = distance
+        return similar
+
+    def __score(self, query: str) -> dict:
+        """Score restaurants matching the query text.
+
+        Return:
+            Dict of restaurant id to score.
+        """
+
+        scores = defaultdict(float)
+        for word in words_of(query):
+            # Whole word matches, exact or fuzzy
+            for candidate, distance in self.__similar_words(word).items():
+                factor = 2.0 / (1 + distance)
+                for restaurant_id, weight in self.__postings.get(("word", candidate), {}).items():
+                    scores[restaurant_id] += factor * weight
+            # Partial matches through shared bigrams, at least half of them
+            grams = bigrams_of(word)
+            hits = defaultdict(list)
+            for gram in set(grams):
+                for restaurant_id, weight in self.__postings.get(("gram", gram), {}).items():
+                    hits[restaurant_id].append(weight)
+            for restaurant_id, weights in hits.items():
+                if len(weights) * 2 >= len(set(grams)):
+                    scores[restaurant_id] += sum(weights) / len(set(grams))
+        return scores
+
+    def search(self, text: str = None, limit: int = 100, offset: int = 0,
+               fields: list = None, **filters) -> list:
+        """Search restaurants.
+
+        Args:
+            text (str): words to match against name, tags and frontend tags,
+                empty to list restaurants matching the filters
+            limit (int): max number of results
+            offset (int): number of best results to skip
+            fields (list): only return these fields and ``_id`` if given
+            filters: exact ``region``, ``time_period`` and ``tags`` filters,
+                empty values are ignored
+
+        Return:
+            Matched restaurants, best match first.
+        """
+
+        allowed = facet_index.match_ids({field: [value] if isinstance(value, str) else value
+                                         for field, value in filters.items()})
+        with self._lock:
+            self.ensure_loaded()
+            # Ties are broken by star and id, so pages of the same query never overlap
+            if text and text.strip():
+                scores = self.__score(text)
+                if allowed is not None:
+                    scores = {restaurant_id: score for restaurant_id, score in scores.items()
+                              if restaurant_id in allowed}
+                ranked = heapq.nsmallest(offset + limit, scores, key=lambda restaurant_id: (
+                    -scores[restaurant_id], -self.__records[restaurant_id]["star"], restaurant_id))
+            else:
+                candidates = self.__records if allowed is None else allowed
+                ranked = heapq.nsmallest(offset + limit, candidates, key=lambda restaurant_id: (
+                    -self.__records[restaurant_id]["star"], restaurant_id))
+            records = [self.__records[restaurant_id] for restaurant_id in ranked[offset:]]
+        if fields:
+            keys = set(fields) | {"_id"}
+            records = [{key: value for key, value in record.items() if key in keys}
+                       for record in records]
+        return records
+
+
+search_engine = RestaurantSearchEngine()
@@ -1,17 +1,25 @@
 """Provide function and class to change user's preference and compute recommend lists."""
 
-from threading import Thread
+from threading import Thread, Lock, Event
+from queue import Queue
+from collections import OrderedDict
+import time
+from uuid import uuid4
 from datetime import datetime, timedelta, timezone
 import random
 import json
 from bson import ObjectId
-import pandas as pd
 import numpy as np
-from sklearn.preprocessing import MultiLabelBinarizer
+from scipy import sparse
 from flask_jwt_extended import get_jwt, create_access_token
-from pymongo.errors import OperationFailure
+from pymongo import ReturnDocument, ReplaceOne, DeleteMany, UpdateOne, ASCENDING, DESCENDING
+from pymongo.errors import BulkWriteError, OperationFailure
+from redis.exceptions import RedisError, ResponseError
 from app import app, redis_db, nckufeed_db, jwt
-from app.models import Restaurant, RecommendList, Comment, Post
+from app.models import Restaurant, RestaurantSummary, RankedRecommendList, Rating, Comment, Post
+from app.metrics import register_metrics
+from app.cache import TwoTierCache
+from app.catalog import CatalogMirror, notify_catalog_change
 
 food_types = ["American Foods",
               "Taiwanese Foods",
@@ -33,17 +41,74 @@ food_types = ["American Foods",
               "Seafood"
             ]
 
-def create_user_hmap(uid: str, preferences: list):
-    """Create hash map in redis for specific user's preference.
+DIRTY_USERS_KEY = "recompute:dirty_users"
+
+# Add preferences to a user's hash unless it holds all of them already,
+# in one round trip. KEYS[1] is the hash, ARGV[1] is "1" to also remove the
+# expiry of the hash, followed by pairs of food type and preference.
+MERGE_PREFERENCES_SCRIPT = """
+for i = 2, #ARGV, 2 do
+    if redis.call("HEXISTS", KEYS[1], ARGV[i]) == 0 then
+        for j = 2, #ARGV, 2 do
+            redis.call("HINCRBYFLOAT", KEYS[1], ARGV[j], ARGV[j + 1])
+        end
+        break
+    end
+end
+if ARGV[1] == "1" then
+    redis.call("PERSIST", KEYS[1])
+end
+return 1
+"""
+
+
+def merge_user_hmap(uid: str, preferences: list, persist: bool):
+    """Add preferences to an incomplete hash, which only holds increments,
+    so it holds the latest preferences. A complete hash is kept as it is.
 
     Args:
         uid (str): user's uid
-        preferences (list): original preferences of user in database
+        preferences (list): preferences in database the increments were
+            added to
+        persist (bool): also remove expiry set when the user logged out
 
     """
 
+    preferences = list(preferences or [])
+    if preferences:
+        # Missing types are 0, so the hash is complete afterwards
+        preferences += [0] * (len(food_types) - len(preferences))
+    arguments = []
     for food_type, preference in zip(food_types, preferences):
-        redis_db.hset(uid, food_type, preference)
+        arguments += [food_type, float(preference)]
+    redis_db.eval(MERGE_PREFERENCES_SCRIPT, 1, uid, "1" if persist else "0", *arguments)
+
+
+def create_user_hmap(uid: str, preferences: list, overwrite: bool = False):
+    """Create hash map in redis for specific user's preference.
+
+    At login a complete hash is the user's latest preferences and is kept
+    as it is, it may hold clicks which are not saved to database yet. An
+    incomplete hash only holds increments, so preferences are added on top
+    of them. With ``overwrite`` the hash is replaced by the preferences.
+
+    Args:
+        uid (str): user's uid
+        preferences (list): original preferences of user in database, or
+            new preferences set by the user with ``overwrite``
+        overwrite (bool): replace the hash instead of merging
+
+    """
+
+    if not overwrite:
+        merge_user_hmap(uid, preferences, persist=True)
+        return
+    pipeline = redis_db.pipeline()
+    mapping = {food_type: float(preference) for food_type, preference
+               in zip(food_types, preference_vector(preferences).tolist())}
+    pipeline.hset(uid, mapping=mapping)
+    pipeline.persist(uid)
+    pipeline.execute()
 
 
 def increase_preference(uid: str, tags: list):
@@ -56,101 +121,715 @@ def increase_preference(uid: str, tags: list):
 
     """
 
+    pipeline = redis_db.pipeline(transaction=False)
     for tag in tags:
-        redis_db.hincrbyfloat(uid, tag, 0.1)
+        pipeline.hincrbyfloat(uid, tag, 0.1)
+    pipeline.sadd(DIRTY_USERS_KEY, uid)
+    pipeline.execute()
+
+
+def read_preferences(uids: list) -> tuple:
+    """Read users' latest preferences. A complete hash in redis holds the
+    latest preferences, an incomplete one was created by
+    ``increase_preference`` after the session hash expired and only holds
+    increments on top of the preferences stored in database.
+
+    Args:
+        uids (list): users' uid
+
+    Return:
+        Tuple of preferences in the order of ``food_types`` for every user,
+        and dict of uid to stored preferences of users with incomplete hash.
+    """
+
+    pipeline = redis_db.pipeline()
+    for uid in uids:
+        pipeline.hmget(uid, food_types)
+    session_preferences = pipeline.execute()
+
+    incomplete = [uid for uid, preferences in zip(uids, session_preferences)
+                  if None in preferences]
+    stored_preferences = {}
+    if incomplete:
+        users = nckufeed_db["users"].find({"uid": {"$in": incomplete}},
+                                          {"_id": 0, "uid": 1, "preference": 1})
+        stored_preferences = {user["uid"]: user.get("preference") or [] for user in users}
+
+    result = []
+    for uid, preferences in zip(uids, session_preferences):
+        if None in preferences:
+            stored = stored_preferences.setdefault(uid, [])
+            stored = stored + [0] * (len(food_types) - len(stored))
+            stored_preferences[uid] = stored
+            result.append([float(stored[i]) + float(preference or 0)
+                           for i, preference in enumerate(preferences)])
+        else:
+            result.append([float(preference) for preference in preferences])
+    return result, stored_preferences
+
+
+def load_preferences(uids: list) -> list:
+    """Load users' latest preferences, see ``read_preferences``.
+
+    Args:
+        uids (list): users' uid
+
+    Return:
+        List of preferences in the order of ``food_types`` for every user.
+    """
+
+    return read_preferences(uids)[0]
+
+
+def save_preferences(uids: list) -> list:
+    """Save users' latest preferences to database.
+
+    Args:
+        uids (list): users' uid
+
+    Return:
+        List of saved preferences in the order of ``uids``.
+    """
+
+    preferences, stored_preferences = read_preferences(uids)
+    # Complete hashes before saving, a login in between then keeps the hash
+    for uid, stored in stored_preferences.items():
+        merge_user_hmap(uid, stored, persist=False)
+    nckufeed_db["users"].bulk_write(
+        [UpdateOne({"uid": uid}, {"$set": {"preference": preference}})
+         for uid, preference in zip(uids, preferences)],
+        ordered=False
+    )
+    return preferences
+
+
+def preference_vector(preferences: list) -> np.ndarray:
+    """Convert a preference list to a float32 vector aligned to ``food_types``.
+
+    Args:
+        preferences (list): user's preferences, missing values are treated as 0
+
+    Return:
+        Vector with one element per food type.
+    """
+
+    vector = np.zeros(len(food_types), dtype=np.float32)
+    for i, preference in enumerate(preferences[:len(food_types)]):
+        if preference is not None:
+            vector[i] = float(preference)
+    return vector
+
+
+def serialize_restaurant(restaurant: dict) -> dict:
+    """Serialize a restaurant document to the payload returned by apis.
+
+    Args:
+        restaurant (dict): restaurant document from database
+
+    Return:
+        Restaurant dict with string ``_id``.
+    """
+
+    return Restaurant(
+        _id=str(restaurant["_id"]),
+        name=restaurant["name"],
+        photos=restaurant.get("photos"),
+        star=restaurant.get("star") or 0,
+        tags=restaurant.get("tags"),
+        frontend_tags=restaurant.get("frontend_tags"),
+        open_hour=restaurant.get("open_hour"),
+        address=restaurant.get("address"),
+        phone_number=restaurant.get("phone_number"),
+        service=restaurant.get("service"),
+        website=restaurant.get("website"),
+        gmap_url=restaurant.get("gmap_url")
+    ).dict(by_alias=True)
+
+
+# Projection of restaurant documents to fields of ``summarize_restaurant``
+SUMMARY_PROJECTION = {
+    "name": 1,
+    "star": 1,
+    "photos": {"$slice": 1},
+    "tags": 1,
+    "frontend_tags.region": 1
+}
+
+
+def summarize_restaurant(restaurant: dict) -> dict:
+    """Serialize a restaurant to the short payload of list apis.
+
+    Args:
+        restaurant (dict): restaurant document, whole or projected with
+            ``SUMMARY_PROJECTION``
+
+    Return:
+        Dict of ``_id``, name, star, first photo, tags and region.
+    """
+
+    photos = restaurant.get("photos") or []
+    region = (restaurant.get("frontend_tags") or {}).get("region") \
+        if isinstance(restaurant.get("frontend_tags"), dict) else None
+    if isinstance(region, (list, tuple)):
+        region = region[0] if region else None
+    return RestaurantSummary(
+        _id=str(restaurant["_id"]),
+        name=restaurant["name"],
+        star=restaurant.get("star") or 0,
+        photo=photos[0] if photos else None,
+        tags=restaurant.get("tags") or [],
+        region=region
+    ).dict(by_alias=True)
+
+
+# Format of release_time of posts created before it was stored as a date,
+# in UTC+8
+LEGACY_RELEASE_TIME_FORMAT = "%Y-%m-%d, %H:%M:%S"
+LEGACY_RELEASE_TIME_ZONE = timezone(timedelta(hours=+8))
+
 
+def serialize_post(post: dict) -> dict:
+    """Serialize a post document to the payload returned by apis, in place.
 
-class RecommendComputeTask(Thread):
-    """The class to compute recommend list when user logout.
+    Args:
+        post (dict): post document from database
+
+    Return:
+        The post with string ``_id`` and ``release_time`` in ISO 8601.
+    """
+
+    if "_id" in post:
+        post["_id"] = str(post["_id"])
+    release_time = post.get("release_time")
+    if isinstance(release_time, datetime):
+        # Dates are read back from database as naive UTC
+        post["release_time"] = release_time.replace(tzinfo=timezone.utc).isoformat()
+    return post
+
+
+class RestaurantFeatureCache(CatalogMirror):
+    """Process-wide cache of restaurants' one hot tag matrix.
+
+    Rows of the matrix follow ``ids`` and columns follow ``food_types``, so a
+    user's preference vector can be multiplied with it directly. The matrix is
+    loaded from database once and then patched when the catalog changes.
     """
 
-    def __init__(self, uid: str):
+    # Use a sparse matrix once the vocabulary is too large for a dense one
+    SPARSE_THRESHOLD = 64
+
+    def __init__(self, vocabulary: list):
+        super(RestaurantFeatureCache, self).__init__()
+        self.__vocabulary = list(vocabulary)
+        self.__columns = {tag: i for i, tag in enumerate(self.__vocabulary)}
+        self.__sparse = len(self.__vocabulary) > self.SPARSE_THRESHOLD
+        self.__ids = []
+        self.__positions = {}
+        self.__records = []
+        self.__matrix = self.__empty_matrix(0)
+
+    def __empty_matrix(self, rows: int):
+        shape = (rows, len(self.__vocabulary))
+        if self.__sparse:
+            return sparse.csr_matrix(shape, dtype=np.float32)
+        return np.zeros(shape, dtype=np.float32)
+
+    def __encode(self, tags: list):
+        """One hot encode tags of one restaurant, unknown tags are ignored."""
+
+        row = np.zeros((1, len(self.__vocabulary)), dtype=np.float32)
+        for tag in tags or []:
+            column = self.__columns.get(tag)
+            if column is not None:
+                row[0, column] = 1
+        if self.__sparse:
+            return sparse.csr_matrix(row)
+        return row
+
+    def _rebuild(self, restaurants):
+        """Rebuild the whole matrix from the restaurants collection."""
+
+        records = [serialize_restaurant(restaurant) for restaurant in restaurants]
+        matrix = self.__empty_matrix(len(records))
+        if records:
+            rows = [self.__encode(record.get("tags")) for record in records]
+            matrix = sparse.vstack(rows, format="csr") if self.__sparse else np.vstack(rows)
+        self.__records = records
+        self.__ids = [record["_id"] for record in records]
+        self.__positions = {restaurant_id: i for i, restaurant_id in enumerate(self.__ids)}
+        self.__matrix = matrix
+
+    def snapshot(self):
+        """Get current restaurants and their tag matrix.
+
+        Return:
+            Tuple of restaurant records and the tag matrix, row i of the
+            matrix belongs to record i.
+        """
+
+        with self._lock:
+            self.ensure_loaded()
+            return self.__records, self.__matrix
+
+    def lookup(self, restaurant_ids: list) -> dict:
+        """Get serialized restaurants by id without loading the cache.
+
+        Args:
+            restaurant_ids (list): restaurants' _id
+
+        Return:
+            Dict of restaurant id to restaurant for ids found in an up to
+            date cache, empty if the cache is not loaded or stale.
+        """
+
+        with self._lock:
+            if not self.is_current():
+                return {}
+            return {restaurant_id: self.__records[self.__positions[restaurant_id]]
+                    for restaurant_id in restaurant_ids if restaurant_id in self.__positions}
+
+    def _add(self, restaurant: dict):
+        """Append a new restaurant to the cache."""
+
+        record = serialize_restaurant(restaurant)
+        if record["_id"] in self.__positions:
+            self.__replace(record)
+            return
+        row = self.__encode(record.get("tags"))
+        if self.__sparse:
+            self.__matrix = sparse.vstack([self.__matrix, row], format="csr")
+        else:
+            self.__matrix = np.vstack([self.__matrix, row])
+        self.__records = self.__records + [record]
+        self.__ids = self.__ids + [record["_id"]]
+        self.__positions[record["_id"]] = len(self.__ids) - 1
+
+    def _update(self, restaurant: dict):
+        """Replace a restaurant and re-encode its tags."""
+
+        record = serialize_restaurant(restaurant)
+        if record["_id"] not in self.__positions:
+            self._loaded = False
+            return
+        self.__replace(record)
+
+    def __replace(self, record: dict):
+        """Replace the row of an existing restaurant. New objects are created
+        instead of modifying in place, so snapshots held by running tasks
+        stay consistent.
+        """
+
+        position = self.__positions[record["_id"]]
+        row = self.__encode(record.get("tags"))
+        if self.__sparse:
+            self.__matrix = sparse.vstack([self.__matrix[:position], row,
+                                           self.__matrix[position + 1:]], format="csr")
+        else:
+            matrix = self.__matrix.copy()
+            matrix[position] = row[0]
+            self.__matrix = matrix
+        records = list(self.__records)
+        records[position] = record
+        self.__records = records
+
+    def _remove(self, restaurant: dict):
+        """Remove a restaurant from the cache."""
+
+        position = self.__positions.get(str(restaurant["_id"]))
+        if position is None:
+            return
+        keep = np.ones(len(self.__ids), dtype=bool)
+        keep[position] = False
+        self.__matrix = self.__matrix[keep]
+        self.__records = [record for i, record in enumerate(self.__records) if i != position]
+        self.__ids = [record["_id"] for record in self.__records]
+        self.__positions = {restaurant_id: i for i, restaurant_id in enumerate(self.__ids)}
+
+
+restaurant_features = RestaurantFeatureCache(food_types)
+restaurant_cache = TwoTierCache("restaurant_cache",
+                                app.config["RESTAURANT_CACHE_TTL"],
+                                app.config["RESTAURANT_CACHE_REDIS_TTL"],
+                                app.config["RESTAURANT_CACHE_SIZE"])
+
+RECOMMEND_PAGE_SIZE = 100
+
+
+def rank_restaurants(similarity: np.ndarray, limit: int = None) -> np.ndarray:
+    """Get indices of restaurants ordered by similarity, highest first.
+
+    Args:
+        similarity (np.ndarray): similarity of every restaurant
+        limit (int): only rank the top ``limit`` restaurants if given
+
+    Return:
+        Array of restaurant indices.
+    """
+
+    if limit is not None and limit < len(similarity):
+        # Select the top k in linear time and only sort them
+        top = np.argpartition(-similarity, limit - 1)[:limit]
+        return top[np.argsort(-similarity[top], kind="stable")]
+    return np.argsort(-similarity, kind="stable")
+
+
+def paginate(ranking: np.ndarray, page_size: int = RECOMMEND_PAGE_SIZE):
+    """Split ranked restaurants into recommend list pages.
+
+    Args:
+        ranking (np.ndarray): restaurant indices from ``rank_restaurants``
+        page_size (int): restaurants of one page
+
+    Yield:
+        Page number and shuffled restaurant indices of that page.
+    """
+
+    for page, start in enumerate(range(0, len(ranking), page_size), start=1):
+        yield page, np.random.permutation(ranking[start:start + page_size])
+
+
+def compute_similarity(preferences: list):
+    """Compute similarity between user's preferences and every restaurant.
+
+    Args:
+        preferences (list): user's preferences in the order of ``food_types``
+
+    Return:
+        Tuple of restaurant records and their similarity.
+    """
+
+    restaurants, tags_matrix = restaurant_features.snapshot()
+    similarity = np.asarray(tags_matrix.dot(preference_vector(preferences))).ravel()
+    return restaurants, similarity
+
+
+def recommend_on_the_fly(uid: str, page: int) -> list:
+    """Compute one page of recommend list without storing it. Used before
+    user's recommend list is computed.
+
+    Args:
+        uid (str): user's uid
+        page (int): page of recommend list, starts from 1
+
+    Return:
+        Restaurants of the page.
+    """
+
+    restaurants, similarity = compute_similarity(load_preferences([uid])[0])
+    ranking = rank_restaurants(similarity, page * RECOMMEND_PAGE_SIZE)
+    start = (page - 1) * RECOMMEND_PAGE_SIZE
+    return [restaurants[i] for i in ranking[start:start + RECOMMEND_PAGE_SIZE]]
+
+
+def recommend_list_requests(uid: str, restaurants: list, similarity: np.ndarray) -> list:
+    """Build bulk write requests which replace a user's whole recommend list.
+
+    Args:
+        uid (str): user's uid
+        restaurants (list): restaurant records from ``RestaurantFeatureCache``
+        similarity (np.ndarray): similarity of every restaurant to the user
+
+    Return:
+        List of requests for ``bulk_write`` on recommend_list collection.
+    """
+
+    store_ids = app.config["RECOMMEND_STORAGE"] == "ids"
+    requests = []
+    for page, indices in paginate(rank_restaurants(similarity)):
+        if store_ids:
+            recommend_list = RankedRecommendList(
+                uid=uid,
+                page=page,
+                restaurants_id=[restaurants[i]["_id"] for i in indices],
+                scores=similarity[indices].tolist()
+            ).dict()
+        else:
+            recommend_list = {
+                "uid": uid,
+                "page": page,
+                "recommendation": [restaurants[i] for i in indices]
+            }
+        requests.append(ReplaceOne({ "uid": uid, "page": page }, recommend_list, upsert=True))
+    # Drop pages left over from a longer previous list
+    requests.append(DeleteMany({ "uid": uid, "page": { "$gt": len(requests) } }))
+    return requests
+
+
+def compute_recommend_list(uid: str, preferences: list = None):
+    """Save a user's preferences and replace the user's recommend list.
+    Called by ``RecomputeScheduler`` workers.
+
+    Args:
+        uid (str): user's uid
+        preferences (list): use these preferences instead of the ones
+            accumulated in redis, redis is left untouched
+
+    """
+
+    # Get user's new preference and save it to database
+    if preferences is not None:
+        new_preferences = preference_vector(preferences).tolist()
+        nckufeed_db["users"].update_one({"uid": uid},
+                                        {"$set": {"preference": new_preferences}})
+    else:
+        new_preferences = save_preferences([uid])[0]
+
+    # Compute similarity with the cached tag matrix
+    restaurants, similarity = compute_similarity(new_preferences)
+
+    # Replace the whole recommend list in one round trip
+    requests = recommend_list_requests(uid, restaurants, similarity)
+    nckufeed_db["recommend_list"].bulk_write(requests, ordered=False)
+
+
+# Recommend list pages held before they are written, one page may carry a
+# full restaurant record for every recommendation
+MAX_PENDING_RECOMMEND_WRITES = 1000
+
+
+def update_recommend_lists(uids: list, preferences: np.ndarray):
+    """Compute and store recommend lists of many users with one matrix product.
+    Pages are written every ``MAX_PENDING_RECOMMEND_WRITES`` requests, so
+    memory doesn't grow with the number of users.
+
+    Args:
+        uids (list): users' uid
+        preferences (np.ndarray): users x food types preference matrix
+
+    """
+
+    restaurants, tags_matrix = restaurant_features.snapshot()
+    # (restaurants x tags) . (tags x users) -> similarity of every user
+    similarity = np.asarray(tags_matrix.dot(preferences.T)).T
+    requests = []
+    for uid, user_similarity in zip(uids, similarity):
+        requests.extend(recommend_list_requests(uid, restaurants, user_similarity))
+        # Write as we go, pages of the whole chunk would not fit in memory
+        if len(requests) >= MAX_PENDING_RECOMMEND_WRITES:
+            nckufeed_db["recommend_list"].bulk_write(requests, ordered=False)
+            requests = []
+    if requests:
+        nckufeed_db["recommend_list"].bulk_write(requests, ordered=False)
+
+
+def recompute_dirty_users(batch_size: int) -> int:
+    """Save preferences and recompute recommend lists of users whose
+    preferences changed since last run.
+
+    Args:
+        batch_size (int): number of users computed together
+
+    Return:
+        Number of users recomputed.
+    """
+
+    count = 0
+    while True:
+        uids = redis_db.spop(DIRTY_USERS_KEY, batch_size)
+        if not uids:
+            return count
+        try:
+            preferences = save_preferences(uids)
+            update_recommend_lists(uids, np.array(preferences, dtype=np.float32))
+        except Exception:
+            # Try these users again next time
+            redis_db.sadd(DIRTY_USERS_KEY, *uids)
+            raise
+        count += len(uids)
+
+
+class DirtyUserRecomputer(Thread):
+    """Thread which periodically recomputes recommend lists of dirty users.
+    """
+
+    def __init__(self, interval: float, batch_size: int):
         """Init thread class and some variables
 
         Args:
-            uid (str): user's uid
-        
+            interval (float): seconds between two runs
+            batch_size (int): number of users computed together
+
         """
-        super(RecommendComputeTask, self).__init__()
-        self.__uid = uid
+        super(DirtyUserRecomputer, self).__init__(daemon=True)
+        self.__interval = interval
+        self.__batch_size = batch_size
+        self.__stopped = Event()
+        self.__counters = {"runs": 0, "recomputed": 0, "failed": 0}
 
     def run(self):
-        """Compute user's preferences and restaurants similarity and insert recommend list
-        to database.
-        """
-
-        # Get user's new preference from redis
-        new_preferences = [float(x) for x in redis_db.hvals(self.__uid)]
-        user_collection = nckufeed_db["users"]
-        user_collection.update_one({"uid": self.__uid}, {"$set": {"preference": new_preferences}})
-        redis_db.delete(self.__uid)
-        new_preferences_matrix = np.array(new_preferences, dtype=np.float32)
-
-        # Get all restaurants' info from database
-        restaurants = nckufeed_db["restaurants"]
-        restaurants_df = pd.DataFrame(list(restaurants.find({})))
-        tags = restaurants_df.loc[:, "tags"]
-
-        # One hot encoding tags and compute similarity
-        mlb = MultiLabelBinarizer()
-        tags_matrix = pd.DataFrame(mlb.fit_transform(tags),
-                                   columns=mlb.classes_,
-                                   index=tags.index).to_numpy(dtype=np.float32)
-        similarity = np.dot(tags_matrix, np.transpose(new_preferences_matrix)).tolist()
-
-        # Insert similarity to dataframe and generate new recommend list
-        restaurants_df.insert(0, "similarity", similarity)
-        restaurants_df.sort_values(by=["similarity"], ascending=False, inplace=True)
-
-        recommendation = []
-        count = 0
-        page = 1
-        recommend_list_collection = nckufeed_db["recommend_list"]
-        for _, row in restaurants_df.iterrows():
-            if count == 100:
-                count = 0
-                random.shuffle(recommendation) # Shuffle list
-                recommend_list = RecommendList(
-                    uid=self.__uid,
-                    page=page,
-                    recommendation=recommendation
-                )
-                recommend_list_collection.find_one_and_update(
-                    { "uid": self.__uid, "page": page },
-                    { "$addToSet": { "recommendation": { "$each": recommend_list.dict(by_alias=True)["recommendation"] } } },
-                    upsert=True
-                )
-                recommendation = []
-                page += 1
-
-            restaurant = Restaurant(
-                _id=str(row["_id"]),
-                name=row["name"],
-                photos=row["photos"],
-                star=row["star"],
-                tags=row["tags"],
-                frontend_tags=row["frontend_tags"],
-                open_hour=row["open_hour"],
-                address=row["address"],
-                phone_number=row["phone_number"],
-                service=row["service"],
-                website=row["website"],
-                gmap_url=row["gmap_url"]
-            )
-            recommendation.append(restaurant.dict(by_alias=True))
-            count += 1
-
-        # Add remaining recommend list to database
-        recommend_list = RecommendList(
-            uid=self.__uid,
-            page=page,
-            recommendation=recommendation
-        )
-        recommend_list_collection.find_one_and_update(
-            { "uid": self.__uid, "page": page },
-            { "$addToSet": { "recommendation": { "$each": recommend_list.dict(by_alias=True)["recommendation"] } } },
-            upsert=True
-        )
+        while not self.__stopped.wait(self.__interval):
+            try:
+                self.__counters["recomputed"] += recompute_dirty_users(self.__batch_size)
+            except Exception as error:
+                print("Recompute dirty users failed!")
+                print(error)
+                self.__counters["failed"] += 1
+            self.__counters["runs"] += 1
+
+    def stop(self):
+        self.__stopped.set()
+
+    def stats(self) -> dict:
+        """Get number of dirty users and run counters."""
+
+        return {"dirty_users": redis_db.scard(DIRTY_USERS_KEY), **self.__counters}
+
+
+dirty_user_recomputer = DirtyUserRecomputer(app.config["RECOMPUTE_INTERVAL"],
+                                            app.config["RECOMPUTE_BATCH_SIZE"])
+register_metrics("dirty_user_recompute", dirty_user_recomputer.stats)
+
+
+RECOMPUTE_JOB_KEY = "recompute_job:{}"
+
+
+class RecomputeJob:
+    """Handle of one scheduled recommend list computation. Its status is
+    kept in redis, so every worker can answer status queries.
+    """
+
+    EXPIRE = timedelta(days=1)
+
+    def __init__(self, uid: str, preferences: list = None):
+        self.job_id = uuid4().hex
+        self.uid = uid
+        self.preferences = preferences
+        self.__done = Event()
+        self.set_status("pending")
+
+    def set_status(self, status: str):
+        self.status = status
+        key = RECOMPUTE_JOB_KEY.format(self.job_id)
+        pipeline = redis_db.pipeline()
+        pipeline.hset(key, mapping={"uid": self.uid, "status": status})
+        pipeline.expire(key, self.EXPIRE)
+        pipeline.execute()
+
+    def finish(self, status: str):
+        try:
+            self.set_status(status)
+        finally:
+            self.__done.set()
+
+    @staticmethod
+    def get_status(job_id: str) -> dict:
+        """Get status of a job from redis.
+
+        Return:
+            Dict with uid and status, empty if the job does not exist.
+        """
+
+        return redis_db.hgetall(RECOMPUTE_JOB_KEY.format(job_id))
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until the computation finished.
+
+        Return:
+            True if the job finished before timeout.
+        """
+
+        return self.__done.wait(timeout)
+
+
+class RecomputeScheduler:
+    """Run ``compute_recommend_list`` on a fixed number of worker threads.
+
+    Jobs of the same user waiting in the queue are coalesced into one, and
+    new jobs are rejected once ``max_pending`` users are waiting.
+    """
+
+    def __init__(self, workers: int, max_pending: int):
+        self.__workers = workers
+        self.__max_pending = max_pending
+        self.__queue = Queue()
+        self.__pending = {}
+        self.__lock = Lock()
+        self.__started = False
+        self.__running = 0
+        self.__counters = {
+            "submitted": 0,
+            "coalesced": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0
+        }
+
+    def __start(self):
+        for _ in range(self.__workers):
+            Thread(target=self.__work, daemon=True).start()
+        self.__started = True
+
+    def submit(self, uid: str, preferences: list = None):
+        """Schedule recommend list computation of a user.
+
+        Args:
+            uid (str): user's uid
+            preferences (list): preferences passed to ``compute_recommend_list``
+
+        Return:
+            RecomputeJob of the user, or None if the queue is full.
+        """
+
+        with self.__lock:
+            if not self.__started:
+                self.__start()
+            self.__counters["submitted"] += 1
+            job = self.__pending.get(uid)
+            if job is not None:
+                self.__counters["coalesced"] += 1
+                if preferences is not None:
+                    job.preferences = preferences
+                return job
+            if len(self.__pending) >= self.__max_pending:
+                self.__counters["rejected"] += 1
+                print("Recompute queue is full, drop job of", uid)
+                return None
+            job = RecomputeJob(uid, preferences)
+            self.__pending[uid] = job
+        self.__queue.put(job)
+        return job
+
+    def __work(self):
+        while True:
+            job = self.__queue.get()
+            with self.__lock:
+                # Jobs submitted from now on will compute again with newer preferences
+                self.__pending.pop(job.uid, None)
+                self.__running += 1
+            try:
+                job.set_status("running")
+                compute_recommend_list(job.uid, job.preferences)
+            except Exception as error:
+                print("Compute recommend list of", job.uid, "failed!")
+                print(error)
+                status = "failed"
+            else:
+                status = "done"
+            with self.__lock:
+                self.__running -= 1
+                self.__counters["completed" if status == "done" else "failed"] += 1
+            try:
+                job.finish(status)
+            except Exception as error:
+                print("Save status of recompute job", job.job_id, "failed!")
+                print(error)
+            self.__queue.task_done()
+
+    def stats(self) -> dict:
+        """Get queue depth and job counters."""
+
+        with self.__lock:
+            return {
+                "workers": self.__workers,
+                "queue_depth": len(self.__pending),
+                "running": self.__running,
+                **self.__counters
+            }
+
+
+recompute_scheduler = RecomputeScheduler(app.config["RECOMPUTE_WORKERS"],
+                                         app.config["RECOMPUTE_MAX_PENDING"])
+register_metrics("recompute", recompute_scheduler.stats)
 
 
 @app.after_request
@@ -178,6 +857,65 @@ def refresh_expiring_jwts(response):
         return response
 
 
+class TokenRevocationCache:
+    """In-process cache of jti revocation checks in front of redis.
+
+    Results are kept for ``ttl`` seconds, so a token revoked on another
+    worker is rejected here at most ``ttl`` seconds later. Tokens revoked
+    on this worker are rejected immediately.
+    """
+
+    def __init__(self, ttl: float, max_size: int):
+        self.__ttl = ttl
+        self.__max_size = max_size
+        self.__entries = OrderedDict()
+        self.__lock = Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    def __put(self, jti: str, revoked: bool, ttl: float):
+        self.__entries[jti] = (revoked, time.monotonic() + ttl)
+        self.__entries.move_to_end(jti)
+        while len(self.__entries) > self.__max_size:
+            self.__entries.popitem(last=False)
+
+    def is_revoked(self, jti: str) -> bool:
+        """Check if the token is revoked, asking redis on cache miss."""
+
+        with self.__lock:
+            entry = self.__entries.get(jti)
+            if entry is not None and entry[1] > time.monotonic():
+                self.__hits += 1
+                return entry[0]
+            self.__misses += 1
+        revoked = redis_db.get(jti) is not None
+        with self.__lock:
+            self.__put(jti, revoked, self.__ttl)
+        return revoked
+
+    def revoke(self, jti: str, expires: timedelta):
+        """Remember a token revoked by this worker.
+
+        Args:
+            jti (str): token's jti
+            expires (timedelta): how long the token stays revoked in redis
+        """
+
+        with self.__lock:
+            self.__put(jti, True, expires.total_seconds())
+
+    def stats(self) -> dict:
+        """Get cache size and hit/miss counters."""
+
+        with self.__lock:
+            return {"size": len(self.__entries), "hits": self.__hits, "misses": self.__misses}
+
+
+token_revocation_cache = TokenRevocationCache(app.config["JWT_REVOCATION_CACHE_TTL"],
+                                              app.config["JWT_REVOCATION_CACHE_SIZE"])
+register_metrics("token_revocation_cache", token_revocation_cache.stats)
+
+
 @jwt.token_in_blocklist_loader
 def check_if_token_is_revoked(_, jwt_payload: dict):
     """Check if the token is valid.
@@ -186,12 +924,281 @@ def check_if_token_is_revoked(_, jwt_payload: dict):
         True if token is revoked.
     """
 
-    jti = jwt_payload["jti"]
-    token_in_redis = redis_db.get(jti)
-    return token_in_redis is not None
+    return token_revocation_cache.is_revoked(jwt_payload["jti"])
+
+
+PENDING_LIKES_KEY = "posts:pending_likes"
+FLUSHING_LIKES_KEY = "posts:pending_likes:flushing"
+FLUSH_LIKES_LOCK_KEY = "posts:pending_likes:lock"
+FLUSH_LIKES_ID_KEY = "posts:pending_likes:flush_id"
+# Field of posts holding id of the last flush applied to them
+LIKE_FLUSH_FIELD = "like_flush"
+
+
+class LikeBuffer:
+    """Accumulate likes of posts in a redis hash and write them to database
+    in batches, so hot posts are not updated on every click.
+    """
+
+    def __init__(self):
+        self.__counters = {"buffered": 0, "flushes": 0, "flushed_posts": 0, "failed": 0}
+
+    def add(self, post_id: str, like: int):
+        """Buffer a like change of a post.
+
+        Args:
+            post_id (str): post's _id
+            like (int): change of like count
+        """
+
+        redis_db.hincrby(PENDING_LIKES_KEY, post_id, like)
+        self.__counters["buffered"] += 1
+
+    def merge(self, posts: list):
+        """Add likes not written to database yet to posts, in place.
+
+        Args:
+            posts (list): posts with string ``_id``
+        """
+
+        if not posts:
+            return
+        post_ids = [post["_id"] for post in posts]
+        # Read in one transaction, so flush id belongs to the flushing hash
+        pipeline = redis_db.pipeline()
+        pipeline.hmget(PENDING_LIKES_KEY, post_ids)
+        pipeline.hmget(FLUSHING_LIKES_KEY, post_ids)
+        pipeline.get(FLUSH_LIKES_ID_KEY)
+        pending, flushing, flush_id = pipeline.execute()
+        for post, pending_like, flushing_like in zip(posts, pending, flushing):
+            # Flushing likes are already counted in posts written by this flush
+            if post.pop(LIKE_FLUSH_FIELD, None) == flush_id is not None:
+                flushing_like = 0
+            post["like"] = post.get("like", 0) + int(pending_like or 0) + int(flushing_like or 0)
+
+    def flush(self) -> int:
+        """Write buffered likes to database with one bulk write.
+
+        Every flush has an id which is set on updated posts, so when the
+        write fails midway the same hash is retried with the same id and
+        posts which were already updated are skipped.
+
+        Return:
+            Number of posts updated.
+        """
+
+        # Only one worker flushes at a time
+        if not redis_db.set(FLUSH_LIKES_LOCK_KEY, "", nx=True, ex=60):
+            return 0
+        try:
+            # Take the whole buffer, new likes go to a new hash meanwhile.
+            # A hash left by a failed flush is written first.
+            if not redis_db.exists(FLUSHING_LIKES_KEY):
+                try:
+                    redis_db.rename(PENDING_LIKES_KEY, FLUSHING_LIKES_KEY)
+                except ResponseError:
+                    # Nothing buffered
+                    return 0
+                redis_db.delete(FLUSH_LIKES_ID_KEY)
+            flush_id = redis_db.get(FLUSH_LIKES_ID_KEY)
+            if flush_id is None:
+                flush_id = uuid4().hex
+                redis_db.set(FLUSH_LIKES_ID_KEY, flush_id)
+            likes = [(post_id, int(like)) for post_id, like
+                     in redis_db.hgetall(FLUSHING_LIKES_KEY).items() if int(like) != 0]
+            requests = [UpdateOne({"_id": ObjectId(post_id), LIKE_FLUSH_FIELD: {"$ne": flush_id}},
+                                  {"$inc": {"like": like}, "$set": {LIKE_FLUSH_FIELD: flush_id}})
+                        for post_id, like in likes]
+            try:
+                if requests:
+                    nckufeed_db["posts"].bulk_write(requests, ordered=False)
+            except BulkWriteError as error:
+                self.__counters["failed"] += 1
+                if error.details.get("writeConcernErrors"):
+                    # Unknown which writes were applied, retry the hash
+                    raise
+                # Other writes were applied, only put failed likes back
+                pipeline = redis_db.pipeline()
+                for write_error in error.details.get("writeErrors", []):
+                    post_id, like = likes[write_error["index"]]
+                    pipeline.hincrby(PENDING_LIKES_KEY, post_id, like)
+                pipeline.delete(FLUSHING_LIKES_KEY, FLUSH_LIKES_ID_KEY)
+                pipeline.execute()
+                raise
+            except Exception:
+                # Unknown which writes were applied, e.g. connection lost,
+                # the hash is retried with the same flush id next time
+                self.__counters["failed"] += 1
+                raise
+            redis_db.delete(FLUSHING_LIKES_KEY, FLUSH_LIKES_ID_KEY)
+        finally:
+            redis_db.delete(FLUSH_LIKES_LOCK_KEY)
+        self.__counters["flushes"] += 1
+        self.__counters["flushed_posts"] += len(requests)
+        return len(requests)
+
+    def stats(self) -> dict:
+        """Get number of posts waiting to be flushed and counters."""
+
+        return {"pending_posts": redis_db.hlen(PENDING_LIKES_KEY), **self.__counters}
+
+
+class LikeFlusher(Thread):
+    """Thread which periodically flushes ``LikeBuffer``.
+    """
+
+    def __init__(self, like_buffer: LikeBuffer, interval: float):
+        super(LikeFlusher, self).__init__(daemon=True)
+        self.__like_buffer = like_buffer
+        self.__interval = interval
+        self.__stopped = Event()
+
+    def run(self):
+        while not self.__stopped.wait(self.__interval):
+            try:
+                self.__like_buffer.flush()
+            except Exception as error:
+                print("Flush post likes failed!")
+                print(error)
+
+    def stop(self):
+        self.__stopped.set()
+
+
+like_buffer = LikeBuffer()
+like_flusher = LikeFlusher(like_buffer, app.config["LIKE_FLUSH_INTERVAL"])
+register_metrics("like_buffer", like_buffer.stats)
+
+
+class RandomRecommendPools:
+    """Shuffled pools of restaurant summaries for random recommendation.
+
+    Pools are sampled from the restaurant feature cache in background, so a
+    request only picks a pool and an offset in it without any query.
+    Catalog changes show up in pools at the next refresh.
+    """
+
+    def __init__(self, count: int, size: int):
+        """Init empty pools.
+
+        Args:
+            count (int): number of pools
+            size (int): max number of restaurants in a pool
+
+        """
+        self.__count = count
+        self.__size = size
+        self.__pools = []
+        self.__refreshed_at = None
+        self.__lock = Lock()
+
+    def refresh(self):
+        """Sample new pools from current restaurants."""
+
+        records, _ = restaurant_features.snapshot()
+        size = min(self.__size, len(records))
+        pools = []
+        for _ in range(self.__count):
+            pools.append([summarize_restaurant(records[i])
+                          for i in random.sample(range(len(records)), size)])
+        with self.__lock:
+            self.__pools = pools
+            self.__refreshed_at = time.time()
+
+    def pick(self, limit: int) -> list:
+        """Get random restaurants from a random pool and offset.
+
+        Args:
+            limit (int): max number of restaurants
+
+        Return:
+            List of restaurant summaries.
+        """
+
+        if not self.__pools:
+            # First request before the refresher ran
+            self.refresh()
+        if not self.__pools:
+            return []
+        pool = random.choice(self.__pools)
+        if len(pool) <= limit:
+            return list(pool)
+        offset = random.randrange(len(pool))
+        return pool[offset:offset + limit] + pool[:max(0, offset + limit - len(pool))]
+
+    def stats(self) -> dict:
+        """Get number and size of pools and time of the last refresh."""
+
+        with self.__lock:
+            return {
+                "pools": len(self.__pools),
+                "size": len(self.__pools[0]) if self.__pools else 0,
+                "refreshed_at": self.__refreshed_at
+            }
+
+
+class RandomPoolRefresher(Thread):
+    """Background thread reshuffling random recommendation pools."""
+
+    def __init__(self, pools: RandomRecommendPools, interval: float):
+        super(RandomPoolRefresher, self).__init__(daemon=True)
+        self.__pools = pools
+        self.__interval = interval
+        self.__stopped = Event()
+
+    def run(self):
+        while True:
+            try:
+                self.__pools.refresh()
+            except Exception as error:
+                print("Refresh random recommendation pools failed!")
+                print(error)
+            if self.__stopped.wait(self.__interval):
+                break
+
+    def stop(self):
+        self.__stopped.set()
+
+
+random_pools = RandomRecommendPools(app.config["RANDOM_POOL_COUNT"], app.config["RANDOM_POOL_SIZE"])
+random_pool_refresher = RandomPoolRefresher(random_pools, app.config["RANDOM_POOL_INTERVAL"])
+register_metrics("random_pools", random_pools.stats)
 
 
 # CRUD
+def build_update(set_fields: dict = None, add_to_set: dict = None,
+                 inc: dict = None, push: dict = None) -> dict:
+    """Merge changes of several fields into one update document, so they
+    are applied atomically in one round trip. Fields set to None are skipped.
+
+    Args:
+        set_fields (dict): field to new value, for ``$set``
+        add_to_set (dict): field to list of values to add if missing
+        inc (dict): field to amount, for ``$inc``
+        push (dict): field to a value or list of values to append
+
+    Return:
+        Update document, empty if nothing changes.
+    """
+
+    update = {}
+    set_fields = {field: value for field, value in (set_fields or {}).items() if value is not None}
+    if set_fields:
+        update["$set"] = set_fields
+    add_to_set = {field: {"$each": list(values)}
+                  for field, values in (add_to_set or {}).items() if values is not None}
+    if add_to_set:
+        update["$addToSet"] = add_to_set
+    inc = {field: amount for field, amount in (inc or {}).items() if amount is not None}
+    if inc:
+        update["$inc"] = inc
+    push = {field: {"$each": list(value)} if isinstance(value, (list, tuple)) else value
+            for field, value in (push or {}).items() if value is not None}
+    if push:
+        update["$push"] = push
+    return update
+
+
 class DatabaseProcessor:
     """Provide functions to take some operation on database.
     """
@@ -201,6 +1208,7 @@ class DatabaseProcessor:
         self.restaurants_collection = nckufeed_db["restaurants"]
         self.users_collection = nckufeed_db["users"]
         self.comments_collection = nckufeed_db["comments"]
+        self.rating_summary_collection = nckufeed_db["rating_summary"]
 
     """used"""
     def insert_restaurant(self, restaurant_info):
@@ -224,8 +1232,9 @@ class DatabaseProcessor:
         """
 
         try:
-            restaurant = Restaurant(**restaurant_info)
-            result = self.restaurants_collection.insert_one(restaurant.dict())
+            restaurant = Restaurant(**restaurant_info).dict()
+            result = self.restaurants_collection.insert_one(restaurant)
+            notify_catalog_change("add", restaurant)
             return {"status": True, "id": result.inserted_id}
         except OperationFailure as error:
             print("Insert new restaurant failed!!")
@@ -239,12 +1248,36 @@ class DatabaseProcessor:
             False if some error happened, else all restaurant info.
         """
         try:
-            restaurants = self.restaurants_collection.find({}, {"_id":0})
+            restaurants = list(self.iter_restaurants(include_id=False))
         except OperationFailure:
             print("Get all restaurants error!")
             return False
         else:
-            return list(restaurants)
+            return restaurants
+
+    def iter_restaurants(self, fields=None, batch_size=1000, include_id=True):
+        """Iterate over all restaurants without loading them at once.
+
+        Args:
+            fields (only return these fields, None for all fields)
+            batch_size (number of documents per round trip)
+            include_id (return _id as string if True)
+
+        Return:
+            Generator of restaurant dicts. OperationFailure is raised while
+            iterating if some error happened.
+        """
+        projection = {field: 1 for field in fields} if fields else {}
+        if not include_id:
+            projection["_id"] = 0
+        cursor = self.restaurants_collection.find({}, projection or None, batch_size=batch_size)
+        try:
+            for restaurant in cursor:
+                if include_id:
+                    restaurant["_id"] = str(restaurant["_id"])
+                yield restaurant
+        finally:
+            cursor.close()
 
     """used"""
     def get_restaurant_info(self, restaurant_id):
@@ -259,7 +1292,7 @@ class DatabaseProcessor:
         """
 
         try:
-            restaurant = self.restaurants_collection.find_one({"_id": ObjectId(restaurant_id)})
+            restaurant = restaurant_cache.get(restaurant_id, self.__find_restaurant)
         except OperationFailure:
             print("Get restaurant info error!")
             return False
@@ -268,8 +1301,46 @@ class DatabaseProcessor:
                 print("There is no such restaurant!")
                 return False
             else:
-                restaurant['_id'] = str(restaurant['_id'])
-                return restaurant
+                return dict(restaurant)
+
+    def __find_restaurant(self, restaurant_id):
+        """Load one restaurant from database for ``restaurant_cache``."""
+
+        restaurant = self.restaurants_collection.find_one({"_id": ObjectId(restaurant_id)})
+        if restaurant is not None:
+            restaurant['_id'] = str(restaurant['_id'])
+        return restaurant
+
+    def get_restaurants(self, restaurant_ids, summary=False):
+        """Get serialized restaurants of many ids, served from the restaurant
+        feature cache when possible and from one $in query otherwise.
+
+        Args:
+            restaurant_ids (list): restaurants' _id
+            summary (bool): return ``summarize_restaurant`` payloads
+
+        Return:
+            False if some error happened, else restaurants in the order of
+            ``restaurant_ids``. Restaurants that no longer exist are skipped.
+        """
+
+        restaurants = restaurant_features.lookup(restaurant_ids)
+        if summary:
+            restaurants = {restaurant_id: summarize_restaurant(restaurant)
+                           for restaurant_id, restaurant in restaurants.items()}
+        missing = [ObjectId(restaurant_id) for restaurant_id in restaurant_ids
+                   if restaurant_id not in restaurants]
+        if missing:
+            serialize = summarize_restaurant if summary else serialize_restaurant
+            try:
+                for restaurant in self.restaurants_collection.find({"_id": {"$in": missing}},
+                                                                   SUMMARY_PROJECTION if summary else None):
+                    restaurants[str(restaurant["_id"])] = serialize(restaurant)
+            except OperationFailure:
+                print("Get restaurants error!")
+                return False
+        return [restaurants[restaurant_id] for restaurant_id in restaurant_ids
+                if restaurant_id in restaurants]
 
     """used"""
     def insert_comment(self, json_input):
@@ -297,6 +1368,7 @@ class DatabaseProcessor:
         try:
             comment = Comment(**json_input)
             inserted_id = str(self.comments_collection.insert_one(comment.dict()).inserted_id)
+            self.__add_rating(comment.target_id, comment.rating.dict(), 1)
             return inserted_id
         except OperationFailure as error:
             print("Insert new restaurant failed!!")
@@ -330,30 +1402,148 @@ class DatabaseProcessor:
             else:
                 return True
 
+    def update_comment_rating(self, json_input):
+        """Update one comment's rating and its target's rating summary
+
+        Args:
+            json_input
+            e.g.  json_input = {
+                    "_id": "",
+                    "rating": {
+                        "cleanliness": 9,
+                        "service": 8,
+                        "deliciousness": 9,
+                        "CPR": 7,
+                        "overall": 9
+                    }
+                  }
+        Return:
+            False if some error happened or comment not exist,
+            else True
+        """
+        try:
+            rating = Rating(**json_input['rating']).dict()
+            comment = self.comments_collection.find_one_and_update({'_id': ObjectId(json_input['_id'])},
+                                                                   {'$set': {'rating': rating}})
+            if comment is not None:
+                # Replace old rating in summary by the new one
+                delta = {key: value - comment.get('rating', {}).get(key, 0)
+                         for key, value in rating.items()}
+                self.__add_rating(comment['target_id'], delta, 0)
+        except OperationFailure:
+            print("update_comment_rating operation failed!")
+            return False
+        else:
+            if comment is None:
+                print("There is no such comment!")
+                return False
+            else:
+                return True
+
+    def __add_rating(self, target_id, rating, count):
+        """Add a rating to the running sums of its target. The comment is
+        already written when this is called, so a failure is only logged and
+        the summary is repaired by ``python -m app.ratings``.
+
+        Args:
+            target_id (restaurant's _id or post's _id)
+            rating (dict of rating dimension to value, negative to remove)
+            count (change of number of ratings)
+        """
+
+        increment = {"sums." + key: value for key, value in rating.items()}
+        increment["count"] = count
+        try:
+            self.rating_summary_collection.update_one({"target_id": target_id},
+                                                      {"$inc": increment},
+                                                      upsert=True)
+        except OperationFailure as error:
+            print("Update rating summary of %s failed, rebuild with python -m app.ratings" % target_id)
+            print(error)
+
+    def get_rating_summaries(self, target_ids):
+        """Get average ratings of restaurants or posts
+
+            Args:
+                target_ids (list of restaurant's _id or post's _id)
+
+            Return:
+                False if some error happened, else dict of target_id to
+                number of ratings and average of every rating dimension.
+                Targets without ratings have count 0.
+        """
+        try:
+            summaries = self.rating_summary_collection.find({"target_id": {"$in": target_ids}},
+                                                            {"_id": 0})
+            summaries = {summary["target_id"]: summary for summary in summaries}
+        except OperationFailure:
+            print("get_rating_summaries operation failed!")
+            return False
+        result = {}
+        for target_id in target_ids:
+            summary = summaries.get(target_id, {})
+            count = summary.get("count", 0)
+            sums = summary.get("sums", {})
+            result[target_id] = {
+                "count": count,
+                "average": {key: sums.get(key, 0) / count if count else 0
+                            for key in Rating.__fields__}
+            }
+        return result
+
+    def rebuild_rating_summaries(self):
+        """Recompute rating summaries of every target from all comments."""
+
+        group = {"_id": "$target_id", "count": {"$sum": 1}}
+        group.update({key: {"$sum": "$rating." + key} for key in Rating.__fields__})
+        requests = [
+            ReplaceOne(
+                {"target_id": summary["_id"]},
+                {
+                    "target_id": summary["_id"],
+                    "count": summary["count"],
+                    "sums": {key: summary[key] for key in Rating.__fields__}
+                },
+                upsert=True
+            )
+            for summary in self.comments_collection.aggregate([{"$group": group}])
+        ]
+        self.rating_summary_collection.delete_many({})
+        if requests:
+            self.rating_summary_collection.bulk_write(requests, ordered=False)
+        return len(requests)
+
     """used"""
-    def get_comment_from_restaurant_or_post(self, target_id):
-        """Get all comments from a restaurant or post
+    def get_comment_from_restaurant_or_post(self, target_id, after=None, limit=None, fields=None):
+        """Get comments from a restaurant or post, oldest first
 
             Args:
                 target_id (restaurant's _id or post's _id)
+                after (_id of the last comment of previous page)
+                limit (max number of comments, all comments if None)
+                fields (list of fields to return, all fields if None)
 
             Return:
                 False if some error happened,
                 else return a comment list.
         """
+        query = {"target_id": target_id}
+        if after is not None:
+            query["_id"] = {"$gt": ObjectId(after)}
+        projection = {field: 1 for field in fields} if fields else None
         try:
-            comments = list(self.comments_collection.find({"target_id": target_id}))
+            # Served by the (target_id, _id) index
+            cursor = self.comments_collection.find(query, projection).sort("_id", ASCENDING)
+            if limit is not None:
+                cursor = cursor.limit(limit)
+            comments = list(cursor)
             for comment in comments:
                 comment["_id"] = str(comment["_id"])
         except OperationFailure:
             print("get_comment_from_restaurant_or_post operation failed!")
             return False
         else:
-            if comments is None:
-                print("There is no such comment!")
-                return False
-            else:
-                return list(comments)
+            return comments
 
     """used"""
     def delete_comment(self, comment_id):
@@ -368,6 +1558,9 @@ class DatabaseProcessor:
         """
         try:
             comment = self.comments_collection.find_one_and_delete({'_id': ObjectId(comment_id)})
+            if comment is not None:
+                rating = {key: -value for key, value in comment.get('rating', {}).items()}
+                self.__add_rating(comment['target_id'], rating, -1)
         except OperationFailure:
             print('delete_comment operation failed!')
             return False
@@ -416,7 +1609,10 @@ class DatabaseProcessor:
         """
         try:
             post = self.posts_collection.find_one({"_id": ObjectId(post_id)})
-        except OperationFailure:
+            if post is not None:
+                serialize_post(post)
+                like_buffer.merge([post])
+        except (OperationFailure, RedisError):
             print("get_post operation failed!")
             return False
         else:
@@ -424,7 +1620,6 @@ class DatabaseProcessor:
                 print("There is no such post!")
                 return False
             else:
-                post['_id'] = str(post['_id'])
                 return post
 
     def get_post_from_restaurant(self, restaurant_id):
@@ -439,8 +1634,9 @@ class DatabaseProcessor:
         try:
             posts = list(self.posts_collection.find({"restaurants_id": restaurant_id}))
             for post in posts:
-                post["_id"] = str(post["_id"])
-        except OperationFailure:
+                serialize_post(post)
+            like_buffer.merge(posts)
+        except (OperationFailure, RedisError):
             print("get_post_from_restaurant operation failed!")
             return False
         else:
@@ -462,8 +1658,9 @@ class DatabaseProcessor:
         try:
             posts = list(self.posts_collection.find({"uid": uid}))
             for post in posts:
-                post["_id"] = str(post["_id"])
-        except OperationFailure:
+                serialize_post(post)
+            like_buffer.merge(posts)
+        except (OperationFailure, RedisError):
             print("get_post_from_user operation failed!")
             return False
         else:
@@ -473,6 +1670,73 @@ class DatabaseProcessor:
             else:
                 return list(posts)
 
+    def get_post_feed(self, restaurant_id=None, uid=None, before=None, limit=20):
+        """Get posts newest first, of a restaurant, a user or everyone
+
+            Args:
+                restaurant_id (restaurant's _id, None for all restaurants)
+                uid (user's uid, None for all users)
+                before ((release_time as datetime, _id) of the last post of
+                    previous page)
+                limit (max number of posts)
+
+            Return:
+                False if some error happened, else return a post list.
+        """
+        query = {}
+        if restaurant_id is not None:
+            query["restaurants_id"] = restaurant_id
+        if uid is not None:
+            query["uid"] = uid
+        if before is not None:
+            release_time, post_id = before
+            query["$or"] = [
+                {"release_time": {"$lt": release_time}},
+                {"release_time": release_time, "_id": {"$lt": ObjectId(post_id)}}
+            ]
+        try:
+            # Range scan on (restaurants_id or uid, release_time, _id) indexes
+            posts = list(self.posts_collection.find(query)
+                         .sort([("release_time", DESCENDING), ("_id", DESCENDING)])
+                         .limit(limit))
+            for post in posts:
+                serialize_post(post)
+            like_buffer.merge(posts)
+        except (OperationFailure, RedisError):
+            print("get_post_feed operation failed!")
+            return False
+        else:
+            return posts
+
+    def convert_release_times(self, batch_size=1000):
+        """Convert release_time strings of old posts to UTC dates, so they
+        sort and page with new posts.
+
+            Args:
+                batch_size (number of posts per bulk write)
+
+            Return:
+                Number of posts converted.
+        """
+        count = 0
+        requests = []
+        for post in self.posts_collection.find({"release_time": {"$type": "string"}},
+                                               {"release_time": 1}):
+            try:
+                release_time = datetime.strptime(post["release_time"], LEGACY_RELEASE_TIME_FORMAT)
+            except ValueError:
+                print("Post %s has invalid release_time %r" % (post["_id"], post["release_time"]))
+                continue
+            release_time = release_time.replace(tzinfo=LEGACY_RELEASE_TIME_ZONE)
+            requests.append(UpdateOne({"_id": post["_id"]},
+                                      {"$set": {"release_time": release_time.astimezone(timezone.utc)}}))
+            if len(requests) >= batch_size:
+                count += self.posts_collection.bulk_write(requests, ordered=False).modified_count
+                requests = []
+        if requests:
+            count += self.posts_collection.bulk_write(requests, ordered=False).modified_count
+        return count
+
     """used"""
     def delete_post(self, post_id):
         """Delete one post
@@ -515,21 +1779,11 @@ class DatabaseProcessor:
             False if some error happened or post not exist,
             else True
         """
-        try:
-            post = self.posts_collection.find_one_and_update({'_id': ObjectId(json_input['_id'])},
-                                                                   {'$set': {'content': json_input['content']}})
-        except OperationFailure:
-            print("update_post_content operation failed!")
-            return False
-        else:
-            if post is None:
-                print("There is no such post!")
-                return False
-            else:
-                return True
+        return self.patch_post(json_input['_id'], build_update(set_fields={'content': json_input['content']}))
 
     def update_post_like(self, json_input):
-        """Update one post's like
+        """Update one post's like. The change is buffered and written to
+        database in batches, reads of posts include buffered likes.
 
         Args:
             json_input
@@ -542,18 +1796,21 @@ class DatabaseProcessor:
             False if some error happened or post not exist,
             else True
         """
+        if not ObjectId.is_valid(json_input['_id']):
+            print("There is no such post!")
+            return False
         try:
-            post = self.posts_collection.find_one_and_update({'_id': ObjectId(json_input['_id'])},
-                                                             {'$inc': {'like': json_input['like']}})
-        except OperationFailure:
+            # Point read on _id, so unknown ids never reach the buffer
+            if self.posts_collection.find_one({'_id': ObjectId(json_input['_id'])}, {'_id': 1}) is None:
+                print("There is no such post!")
+                return False
+            # Written to database later by like_flusher
+            like_buffer.add(json_input['_id'], json_input['like'])
+        except (OperationFailure, RedisError):
             print("update_post_like operation failed!")
             return False
         else:
-            if post is None:
-                print("There is no such post!")
-                return False
-            else:
-                return True
+            return True
 
     """used"""
     def update_post_title(self, json_input):
@@ -570,19 +1827,88 @@ class DatabaseProcessor:
             False if some error happened or post not exist,
             else True
         """
+        return self.patch_post(json_input['_id'], build_update(set_fields={'title': json_input['title']}))
+
+    def patch_restaurant(self, restaurant_id, update):
+        """Apply all changes of one restaurant in one update.
+
+        Args:
+            restaurant_id (_id)
+            update (update document from ``build_update``)
+            e.g.  update = {
+                    "$set": {"website": "www.google.com"},
+                    "$addToSet": {"tags": {"$each": ["Street Foods"]}}
+                  }
+
+        Return:
+            False if some error happened or restaurant not exist,
+            else True
+        """
+        if not update:
+            return True
         try:
-            post = self.posts_collection.find_one_and_update({'_id': ObjectId(json_input['_id'])},
-                                                                   {'$set': {'title': json_input['title']}})
+            # The document after the change patches the in-process mirrors
+            restaurant = self.restaurants_collection.find_one_and_update({'_id': ObjectId(restaurant_id)},
+                                                                         update,
+                                                                         return_document=ReturnDocument.AFTER)
         except OperationFailure:
-            print("update_post_title operation failed!")
+            print("patch_restaurant operation failed!")
             return False
         else:
-            if post is None:
+            if restaurant is None:
+                print('There is no such restaurant')
+                print(restaurant_id)
+                return False
+            else:
+                restaurant_cache.invalidate(restaurant_id)
+                notify_catalog_change("update", restaurant)
+                return True
+
+    def patch_post(self, post_id, update):
+        """Apply all changes of one post in one update.
+
+        Args:
+            post_id (_id)
+            update (update document from ``build_update``)
+
+        Return:
+            False if some error happened or post not exist,
+            else True
+        """
+        if not update:
+            return True
+        try:
+            result = self.posts_collection.update_one({'_id': ObjectId(post_id)}, update)
+        except OperationFailure:
+            print("patch_post operation failed!")
+            return False
+        else:
+            if result.matched_count == 0:
                 print("There is no such post!")
                 return False
             else:
                 return True
 
+    def patch_user(self, uid, update):
+        """Apply all changes of one user in one update.
+
+        Args:
+            uid (user's uid)
+            update (update document from ``build_update``)
+
+        Return:
+            None if some error happened or user not exist,
+            else the user document after the change.
+        """
+        try:
+            if not update:
+                return self.users_collection.find_one({"uid": uid})
+            return self.users_collection.find_one_and_update({"uid": uid}, update,
+                                                             return_document=ReturnDocument.AFTER)
+        except OperationFailure:
+            print("patch_user operation failed!")
+            return None
+
     """used"""
     def update_restaurant_open_hour(self, json_input):
         """Update one restaurant's open hour
@@ -598,20 +1924,7 @@ class DatabaseProcessor:
             False if some error happened or restaurant not exist,
             else True
         """
-        """addToSet prevent duplicate elements, each to push multi elements"""
-        try:
-            restaurant = self.restaurants_collection.find_one_and_update({'_id': ObjectId(json_input["_id"])},
-                                                                         {'$addToSet': {'open_hour': {'$each': json_input['open_hour']}}})
-        except OperationFailure:
-            print("update_restaurant_open_hour operation failed!")
-            return False
-        else:
-            if restaurant is None:
-                print('There is no such restaurant')
-                print(json_input['_id'])
-                return False
-            else:
-                return True
+        return self.patch_restaurant(json_input['_id'], build_update(add_to_set={'open_hour': json_input['open_hour']}))
 
     """used"""
     def update_restaurant_phone_number(self, json_input):
@@ -628,19 +1941,7 @@ class DatabaseProcessor:
             False if some error happened or restaurant not exist,
             else True
         """
-        try:
-            restaurant = self.restaurants_collection.find_one_and_update({'_id': ObjectId(json_input['_id'])},
-                                                                         {'$set': {'phone_number':json_input['phone_number']}})
-        except OperationFailure:
-            print("update_restaurant_phone_number operation failed!")
-            return False
-        else:
-            if restaurant is None:
-                print('There is no such restaurant')
-                print(json_input['_id'])
-                return False
-            else:
-                return True
+        return self.patch_restaurant(json_input['_id'], build_update(set_fields={'phone_number': json_input['phone_number']}))
 
     """used"""
     def update_restaurant_service(self, json_input):
@@ -657,18 +1958,7 @@ class DatabaseProcessor:
             False if some error happened or restaurant not exist,
             else True
         """
-        try:
-            restaurant = self.restaurants_collection.find_one_and_update({'_id': ObjectId(json_input['_id'])},
-                                                                         {'$addToSet': {'service': {'$each': json_input['service']}}})
-        except OperationFailure:
-            print("update_restaurant_service operation failed!")
-            return False
-        else:
-            if restaurant is None:
-                print('There is no such restaurant')
-                return False
-            else:
-                return True
+        return self.patch_restaurant(json_input['_id'], build_update(add_to_set={'service': json_input['service']}))
 
     """used"""
     def update_restaurant_website(self, json_input):
@@ -685,18 +1975,7 @@ class DatabaseProcessor:
             False if some error happened or restaurant not exist,
             else True
         """
-        try:
-            restaurant = self.restaurants_collection.find_one_and_update({'_id': ObjectId(json_input['_id'])},
-                                                                         {'$set': {'website':json_input['website']}})
-        except OperationFailure:
-            print("update_restaurant_web operation failed!")
-            return False
-        else:
-            if restaurant is None:
-                print('There is no such restaurant')
-                return False
-            else:
-                return True
+        return self.patch_restaurant(json_input['_id'], build_update(set_fields={'website': json_input['website']}))
 
     """used"""
     def update_restaurant_tags(self, json_input):
@@ -713,19 +1992,7 @@ class DatabaseProcessor:
             False if some error happened or restaurant not exist,
             else True
         """
-        try:
-            restaurant = self.restaurants_collection.find_one_and_update({'_id': ObjectId(json_input["_id"])},
-                                                                         {'$addToSet': {'tags': {'$each':json_input['tags']}}})
-        except OperationFailure:
-            print("update_restaurant_tag operation failed!")
-            return False
-        else:
-            if restaurant is None:
-                print('There is no such restaurant')
-                print(json_input['_id'])
-                return False
-            else:
-                return True
+        return self.patch_restaurant(json_input['_id'], build_update(add_to_set={'tags': json_input['tags']}))
 
     """used"""
 
@@ -743,20 +2010,7 @@ class DatabaseProcessor:
             False if some error happened or restaurant not exist,
             else True
         """
-        try:
-            restaurant = self.restaurants_collection.find_one_and_update({'_id': ObjectId(json_input["_id"])},
-                                                                         {'$addToSet': {
-                                                                             'photos': {'$each': json_input['photos']}}})
-        except OperationFailure:
-            print("update_restaurant_photos operation failed!")
-            return False
-        else:
-            if restaurant is None:
-                print('There is no such restaurant')
-                print(json_input['_id'])
-                return False
-            else:
-                return True
+        return self.patch_restaurant(json_input['_id'], build_update(add_to_set={'photos': json_input['photos']}))
 
     """used"""
     def delete_restaurant(self, restaurant_id):
@@ -783,4 +2037,6 @@ class DatabaseProcessor:
                 print("There is no such restaurant!")
                 return False
             else:
+                restaurant_cache.invalidate(restaurant_id)
+                notify_catalog_change("remove", restaurant)
                 return True
\ No newline at end of file
@@ -1,4 +1,11 @@
 from app import app
+from app.index_manager import ensure_indexes
+from app.utils import dirty_user_recomputer, like_flusher, random_pool_refresher
+
+ensure_indexes()
+dirty_user_recomputer.start()
+like_flusher.start()
+random_pool_refresher.start()
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file